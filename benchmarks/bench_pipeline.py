@@ -0,0 +1,198 @@
+"""
+End-to-end pipeline benchmark against the local fake Gemini server.
+
+Drives story -> character -> page prompts -> images for each book size and
+reports wall time, per-stage latency, peak RSS and bytes written. Every size
+runs in a fresh subprocess with its own working directory, so caches and
+peak RSS never leak between runs.
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --pages 1 10 100 --mode batch --latency 0.5 --json results.json
+    python -m benchmarks.bench_pipeline --mode pipelined   # page prompts and images overlap
+    python -m benchmarks.bench_pipeline --characters 5 --no-context-cache  # resend the characters with every page
+    python -m benchmarks.bench_pipeline --rate-limit 5 [--no-rate-limiter]  # quota of 5 requests/s per model
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("story", "character", "page_prompts", "images")
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _io_write_bytes():
+    try:
+        with open("/proc/self/io", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_book(pages, mode):
+    """Runs one book in the current process (working directory and env already set up)."""
+    sys.path.insert(0, REPO_ROOT)
+    from utils.llm_utils import stream_story_prompt, generate_page_prompt
+    from utils.image_utils import generate_character_nanobanana, generate_image_nanobanana
+    from utils.pipeline import generate_book_pipelined
+
+    io_before = _io_write_bytes()
+    timings = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    for story in stream_story_prompt("The Benchmark Fox", "Adventure", "Whimsical", "Watercolor", pages, "5-7", use_cache=False):
+        if story.get("story") and "story_first_token" not in timings:
+            timings["story_first_token"] = time.perf_counter() - t
+    timings["story"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    characters = []
+    for i, char in enumerate(story["character"]):
+        path, error = generate_character_nanobanana([f"{char['name']}, {char['trait']}"], "Adventure", "Whimsical", "Watercolor", i, "1:1")
+        characters.append({"name": char["name"], "traits": char["trait"], "image": path})
+    timings["character"] = time.perf_counter() - t
+
+    if mode == "pipelined":
+        # Page prompts and images overlap, so both stages are reported as one.
+        t = time.perf_counter()
+        storybook, img_paths, errors = generate_book_pipelined("The Benchmark Fox", "Adventure", "Whimsical", "Watercolor", pages, "5-7", characters, story["story"], ratio="1:1")
+        timings["page_prompts"] = 0.0
+        timings["images"] = time.perf_counter() - t
+        return _result(pages, mode, start, timings, img_paths, io_before)
+
+    t = time.perf_counter()
+    storybook = generate_page_prompt("The Benchmark Fox", "Adventure", "Whimsical", "Watercolor", pages, "5-7", characters, story["story"], use_cache=False)
+    timings["page_prompts"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    image_prompts = [page["image_prompt"] for page in storybook["pages"]]
+    img_paths, errors = generate_image_nanobanana(image_prompts, characters=characters, ratio="1:1", mode=mode)
+    timings["images"] = time.perf_counter() - t
+
+    return _result(pages, mode, start, timings, img_paths, io_before)
+
+
+def _result(pages, mode, start, timings, img_paths, io_before):
+    from utils import tracing
+    io_after = _io_write_bytes()
+    return {
+        "pages": pages,
+        "mode": mode,
+        "wall_seconds": time.perf_counter() - start,
+        "stages": timings,
+        "images_ok": sum(1 for path in img_paths if path),
+        "images_failed": sum(1 for path in img_paths if not path),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bytes_written": _dir_bytes(os.getcwd()),
+        "io_write_bytes": None if io_before is None or io_after is None else io_after - io_before,
+        "spans": tracing.summary(),
+    }
+
+
+def _server_tokens(base_url):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response).get("tokens", {"prompt_tokens": 0, "cached_tokens": 0})
+
+
+def _run_child(pages, mode, base_url, context_cache=True, rate_limiter=True):
+    workdir = tempfile.mkdtemp(prefix=f"bench_{pages}_")
+    env = dict(os.environ, GEMINI_BASE_URL=base_url, GOOGLE_API_KEY="fake-benchmark-key", PYTHONPATH=REPO_ROOT,
+               STORYBOOK_CONTEXT_CACHE="1" if context_cache else "0", STORYBOOK_RATE_LIMIT="1" if rate_limiter else "0")
+    tokens_before = _server_tokens(base_url)
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_pipeline", "--child", str(pages), "--mode", mode],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark for {pages} pages failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    # Input tokens as the fake server bills them, cached context tokens included.
+    tokens_after = _server_tokens(base_url)
+    result["input_tokens"] = tokens_after["prompt_tokens"] - tokens_before["prompt_tokens"]
+    result["cached_tokens"] = tokens_after["cached_tokens"] - tokens_before["cached_tokens"]
+    return result
+
+
+def _print_table(results):
+    header = f"{'pages':>5} {'mode':>11} {'wall s':>8} " + " ".join(f"{stage:>12}" for stage in STAGES) + f" {'ok/fail':>8} {'rss MB':>7} {'written MB':>10} {'in ktok':>8} {'cached':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        stages = " ".join(f"{r['stages'][stage]:>12.2f}" for stage in STAGES)
+        print(f"{r['pages']:>5} {r['mode']:>11} {r['wall_seconds']:>8.2f} {stages} "
+              f"{r['images_ok']:>3}/{r['images_failed']:<4} {r['peak_rss_mb']:>7.1f} {r['bytes_written'] / 1e6:>10.1f} "
+              f"{r['input_tokens'] / 1e3:>8.1f} {r['cached_tokens'] / 1e3:>8.1f}")
+
+
+def _print_spans(results):
+    # Where the time went, per traced operation (see utils/tracing.py); spans overlap across threads.
+    for r in results:
+        if not r.get("spans"):
+            continue
+        print(f"\n{r['pages']} pages: {'span':<26} {'count':>6} {'total s':>9} {'mean s':>8} {'MB':>8}")
+        for name, entry in sorted(r["spans"].items(), key=lambda item: -item[1]["seconds"]):
+            print(f"{'':>{len(str(r['pages'])) + 8}}{name:<26} {entry['count']:>6} {entry['seconds']:>9.2f} "
+                  f"{entry['seconds'] / entry['count']:>8.3f} {entry['bytes'] / 1e6:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--mode", choices=["interactive", "batch", "auto", "pipelined"], default="interactive")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--block-rate", type=float, default=0.0)
+    parser.add_argument("--batch-queue-seconds", type=float, default=1.0)
+    parser.add_argument("--text-seconds-per-page", type=float, default=0.0, help="extra fake LLM latency per page prompt written")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fake per-model quota in requests per second (429 beyond it)")
+    parser.add_argument("--no-rate-limiter", action="store_true", help="turn off the client-side adaptive rate limiter")
+    parser.add_argument("--characters", type=int, default=1, help="characters the fake story suggests")
+    parser.add_argument("--no-context-cache", action="store_true", help="send the character context with every page request")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_book(args.child, args.mode)))
+        return
+
+    sys.path.insert(0, REPO_ROOT)
+    from benchmarks.fake_gemini import start_server
+    server, base_url = start_server(
+        latency=args.latency, failure_rate=args.failure_rate, block_rate=args.block_rate,
+        batch_queue_seconds=args.batch_queue_seconds, text_seconds_per_page=args.text_seconds_per_page, seed=0,
+        story_characters=args.characters, rate_limit=args.rate_limit,
+    )
+    try:
+        results = [_run_child(pages, args.mode, base_url, not args.no_context_cache, not args.no_rate_limiter) for pages in args.pages]
+    finally:
+        server.shutdown()
+    _print_table(results)
+    _print_spans(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
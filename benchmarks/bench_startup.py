@@ -0,0 +1,96 @@
+"""
+Cold-start benchmark for main.py.
+
+Each run starts a fresh interpreter in an empty working directory and measures
+how long streamlit takes to import and how long the first render of main.py
+takes, then lists which heavy SDKs that first render imported. The app should
+render without loading any of them; they are imported when a generation starts.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 5 --max-first-render 1.5   # exits 1 on regression
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that must not be needed to render the app before any generation starts.
+HEAVY_MODULES = ("google.genai", "langchain_google_genai", "langchain_core", "PIL.Image", "utils.llm_utils", "utils.image_utils")
+
+
+def measure_once():
+    """Runs in the child process: import streamlit, render main.py once."""
+    t = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    streamlit_import = time.perf_counter() - t
+
+    t = time.perf_counter()
+    at = AppTest.from_file(os.path.join(REPO_ROOT, "main.py"), default_timeout=120).run()
+    first_render = time.perf_counter() - t
+    return {
+        "streamlit_import_seconds": streamlit_import,
+        "first_render_seconds": first_render,
+        "exceptions": [e.message for e in at.exception],
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def _run_child():
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    t = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Startup benchmark failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - t
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-first-render", type=float, help="fail if the median first render takes longer (seconds)")
+    parser.add_argument("--allow-heavy", action="store_true", help="don't fail when the first render imports a heavy SDK")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_once()))
+        return
+
+    results = [_run_child() for _ in range(args.runs)]
+    print(f"{'run':>3} {'streamlit s':>12} {'first render s':>15} {'process s':>10}  heavy modules")
+    for i, r in enumerate(results, start=1):
+        print(f"{i:>3} {r['streamlit_import_seconds']:>12.2f} {r['first_render_seconds']:>15.2f} {r['process_seconds']:>10.2f}  "
+              f"{', '.join(r['heavy_modules']) or '-'}")
+    median_render = statistics.median(r["first_render_seconds"] for r in results)
+    print(f"median first render: {median_render:.2f}s")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    problems = []
+    for r in results:
+        problems += [f"first render raised: {message}" for message in r["exceptions"]]
+    heavy = sorted({name for r in results for name in r["heavy_modules"]})
+    if heavy and not args.allow_heavy:
+        problems.append(f"first render imported {', '.join(heavy)}")
+    if args.max_first_render is not None and median_render > args.max_first_render:
+        problems.append(f"median first render {median_render:.2f}s exceeds {args.max_first_render:.2f}s")
+    if problems:
+        print("\n".join(problems), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
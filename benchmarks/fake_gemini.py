@@ -0,0 +1,465 @@
+"""
+Local stand-in for the Gemini endpoints the app uses, so the pipeline can be
+benchmarked and regression-tested without a live, billed API key.
+
+Serves generateContent and streamGenerateContent (text and image models), the resumable files.upload
+protocol, files.download, batches.create/get with inline or JSONL file
+sources and cachedContents.create. Prompt and cached tokens are counted (an image
+part as IMAGE_PART_TOKENS) and reported with the request stats at /_stats. Latency, failure and block rates and a per-model quota are configurable; images are
+synthetic PNGs.
+
+    python -m benchmarks.fake_gemini --port 8765 --latency 0.5 --failure-rate 0.05
+    GEMINI_BASE_URL=http://127.0.0.1:8765 GOOGLE_API_KEY=fake streamlit run main.py
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+TERMINAL_BATCH_STATES = ("BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED")
+IMAGE_PART_TOKENS = 258
+CACHE_MIN_TOKENS = 1024
+
+
+class FakeGeminiState:
+    def __init__(self, latency=0.2, jitter=0.1, failure_rate=0.0, block_rate=0.0,
+                 batch_queue_seconds=1.0, batch_run_seconds=1.0, image_size=512, seed=None,
+                 text_seconds_per_page=0.0, stream_chunk_chars=40, stream_chunk_seconds=0.02,
+                 story_characters=1, rate_limit=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.block_rate = block_rate
+        self.batch_queue_seconds = batch_queue_seconds
+        self.batch_run_seconds = batch_run_seconds
+        # Text calls also pay for their output length, like real token generation.
+        self.text_seconds_per_page = text_seconds_per_page
+        self.stream_chunk_chars = stream_chunk_chars
+        self.stream_chunk_seconds = stream_chunk_seconds
+        # Characters suggested with the story; each reference image also rides along with every page.
+        self.story_characters = story_characters
+        # Requests per second per model before answering 429 like an exhausted quota (0: unlimited).
+        self.rate_limit = rate_limit
+        self.buckets = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.upload_sessions = {}
+        self.batches = {}
+        self.cached_contents = {}
+        self.stats = {}
+        self.images = [self._render_image(image_size, i) for i in range(4)]
+
+    def _render_image(self, size, i):
+        # Noise keeps the PNG close to the size of a real illustration.
+        image = Image.effect_noise((size, size), 40 + 10 * i).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    def count(self, name, request_bytes=0):
+        with self.lock:
+            entry = self.stats.setdefault(name, {"requests": 0, "request_bytes": 0})
+            entry["requests"] += 1
+            entry["request_bytes"] += request_bytes
+
+    def count_tokens(self, prompt_tokens, cached_tokens):
+        with self.lock:
+            entry = self.stats.setdefault("tokens", {"prompt_tokens": 0, "cached_tokens": 0})
+            entry["prompt_tokens"] += prompt_tokens
+            entry["cached_tokens"] += cached_tokens
+
+    def admit(self, model):
+        """Token bucket per model with a one second burst; False means the quota is exhausted."""
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(model, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - updated) * self.rate_limit)
+            admitted = tokens >= 1
+            self.buckets[model] = (tokens - 1 if admitted else tokens, now)
+            return admitted
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def sleep(self):
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        time.sleep(delay)
+
+    def image_response(self):
+        if self.roll(self.block_rate):
+            return {"promptFeedback": {"blockReason": "SAFETY"}}
+        with self.lock:
+            data = self.random.choice(self.images)
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"inlineData": {"mimeType": "image/png", "data": data}}]},
+                "finishReason": "STOP",
+            }],
+            "usageMetadata": {"promptTokenCount": 0, "candidatesTokenCount": 1290},
+        }
+
+    def text_response(self, prompt):
+        pages = re.search(r"Generate exactly (\d+) pages", prompt)
+        if pages:
+            count = int(pages.group(1))
+            time.sleep(count * self.text_seconds_per_page)
+            payload = {
+                "book_name": "A Benchmark Book",
+                "pages": [
+                    {"text": f"Page {i + 1} of the story.",
+                     "image_prompt": f"A watercolor scene number {i + 1} with a small fox in a forest."}
+                    for i in range(count)
+                ],
+            }
+        else:
+            payload = {
+                "story": "Once upon a time a small fox went looking for the moon. " * 20,
+                "character": [{"name": "Fox", "trait": "A small orange fox with a green scarf."}] + [
+                    {"name": f"Friend {i}", "trait": f"Friend number {i} of the fox: a tall grey heron with long legs, a yellow beak, "
+                                                     "a patched blue raincoat, round glasses and a calm, thoughtful way of speaking."}
+                    for i in range(1, self.story_characters)
+                ],
+            }
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": json.dumps(payload)}]},
+                "finishReason": "STOP",
+            }],
+            "usageMetadata": {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": 200},
+        }
+
+    def content_tokens(self, contents):
+        tokens = 0
+        for content in contents:
+            for part in content.get("parts", []):
+                tokens += len(part.get("text", "")) // 4
+                if "fileData" in part or "inlineData" in part:
+                    tokens += IMAGE_PART_TOKENS
+        return tokens
+
+    def create_cached_content(self, body):
+        """Stores a cached content. Returns its record, or None when it is below CACHE_MIN_TOKENS."""
+        contents = body.get("contents", []) + ([body["systemInstruction"]] if body.get("systemInstruction") else [])
+        tokens = self.content_tokens(contents)
+        if tokens < CACHE_MIN_TOKENS:
+            return None, tokens
+        ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        record = {
+            "name": name,
+            "model": body.get("model"),
+            "displayName": body.get("displayName", ""),
+            "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + ttl)),
+            "usageMetadata": {"totalTokenCount": tokens},
+        }
+        with self.lock:
+            self.cached_contents[name] = {"record": record, "tokens": tokens, "expires": time.time() + ttl}
+        return record, tokens
+
+    def generate(self, model, body):
+        """Raises LookupError for an unknown or expired cachedContent, like the API's 404."""
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            with self.lock:
+                cached = self.cached_contents.get(body["cachedContent"])
+            if cached is None or cached["expires"] < time.time():
+                raise LookupError(f"CachedContent not found (or permission denied): {body['cachedContent']}")
+            cached_tokens = cached["tokens"]
+        prompt_tokens = self.content_tokens(body.get("contents", [])) + cached_tokens
+        self.count_tokens(prompt_tokens, cached_tokens)
+        texts = [part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])]
+        if "image" in model:
+            response = self.image_response()
+        else:
+            response = self.text_response("\n".join(texts))
+        response.setdefault("usageMetadata", {}).update(promptTokenCount=prompt_tokens, cachedContentTokenCount=cached_tokens)
+        return response
+
+    def stream_chunks(self, response):
+        """Splits a text response into the chunks streamGenerateContent would send."""
+        parts = response.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+        text = "".join(part.get("text", "") for part in parts)
+        if not text:
+            return [response]
+        size = self.stream_chunk_chars
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        chunks = []
+        for i, piece in enumerate(pieces):
+            candidate = {"content": {"role": "model", "parts": [{"text": piece}]}}
+            if i == len(pieces) - 1:
+                candidate["finishReason"] = "STOP"
+            chunks.append({"candidates": [candidate]})
+        chunks[-1]["usageMetadata"] = response.get("usageMetadata", {})
+        return chunks
+
+    def batch_response(self, model, request):
+        try:
+            return {"key": request.get("key"), "response": self.generate(model, request.get("request", request))}
+        except LookupError as e:
+            return {"key": request.get("key"), "error": {"code": 404, "message": str(e), "status": "NOT_FOUND"}}
+
+    def batch_view(self, name):
+        with self.lock:
+            batch = self.batches[name]
+            elapsed = time.time() - batch["created"]
+            if batch["state"] not in TERMINAL_BATCH_STATES:
+                if elapsed < self.batch_queue_seconds:
+                    batch["state"] = "BATCH_STATE_PENDING"
+                elif elapsed < self.batch_queue_seconds + self.batch_run_seconds:
+                    batch["state"] = "BATCH_STATE_RUNNING"
+                else:
+                    batch["state"] = "BATCH_STATE_SUCCEEDED"
+            finished = batch["state"] == "BATCH_STATE_SUCCEEDED" and "output" not in batch
+        if finished:
+            responses = [self.batch_response(batch["model"], request) for request in batch["requests"]]
+            with self.lock:
+                if batch["file_sourced"]:
+                    results_name = f"files/{uuid.uuid4().hex[:12]}"
+                    data = "".join(json.dumps(response) + "\n" for response in responses).encode("utf-8")
+                    self.files[results_name] = {"record": {"name": results_name, "mimeType": "application/jsonl"}, "data": data}
+                    batch["output"] = {"responsesFile": results_name}
+                else:
+                    for response in responses:
+                        response.pop("key")
+                    batch["output"] = {"inlinedResponses": {"inlinedResponses": responses}}
+        with self.lock:
+            metadata = {"@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                        "model": batch["model"], "displayName": batch["display_name"], "state": batch["state"]}
+            if "output" in batch:
+                metadata["output"] = batch["output"]
+            return {"name": name, "metadata": metadata}
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    server_version = "FakeGemini/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks, sse=False):
+        # SSE for the genai SDK (alt=sse), otherwise a chunked JSON array as the REST transports expect.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.state.stream_chunk_seconds)
+            if sse:
+                write(f"data: {json.dumps(chunk)}\r\n\r\n".encode("utf-8"))
+            else:
+                write((("[" if i == 0 else ",") + json.dumps(chunk)).encode("utf-8"))
+        if not sse:
+            write(b"]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_error(self, status, message, reason):
+        self._send_json(status, {"error": {"code": status, "message": message, "status": reason}})
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/_stats":
+            with self.state.lock:
+                self._send_json(200, self.state.stats)
+            return
+        match = re.search(r"/(files/[^/:]+):download$", path)
+        if match and match.group(1) in self.state.files:
+            self.state.count("files.download")
+            data = self.state.files[match.group(1)]["data"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        match = re.search(r"/(batches/[^/:]+)$", path)
+        if match and match.group(1) in self.state.batches:
+            self.state.count("batches.get")
+            self._send_json(200, self.state.batch_view(match.group(1)))
+            return
+        self._send_error(404, f"Unknown path {path}", "NOT_FOUND")
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        raw = self._read_body()
+
+        if path.startswith("/upload-session/"):
+            self._finish_upload(path.rsplit("/", 1)[-1], raw)
+            return
+        if path.endswith("/files") and self.headers.get("X-Goog-Upload-Protocol") == "resumable":
+            self._start_upload(raw)
+            return
+        if path.endswith("/cachedContents"):
+            self._create_cached_content(raw)
+            return
+
+        match = re.search(r"/models/([^/:]+):(generateContent|streamGenerateContent|batchGenerateContent)$", path)
+        if not match:
+            self._send_error(404, f"Unknown path {path}", "NOT_FOUND")
+            return
+        model, method = match.groups()
+        body = json.loads(raw or b"{}")
+        self.state.count(method, len(raw))
+        if not self.state.admit(model):
+            self.state.count("throttled")
+            self._send_json(429, {"error": {
+                "code": 429, "message": "Resource has been exhausted (e.g. check quota). (fake)", "status": "RESOURCE_EXHAUSTED",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}],
+            }})
+            return
+        self.state.sleep()
+        if self.state.roll(self.state.failure_rate):
+            self._send_error(503, "The model is overloaded (fake).", "UNAVAILABLE")
+            return
+        if method == "batchGenerateContent":
+            self._create_batch(model, body)
+            return
+        try:
+            response = self.state.generate(model, body)
+        except LookupError as e:
+            self._send_error(404, str(e), "NOT_FOUND")
+            return
+        if method == "generateContent":
+            self._send_json(200, response)
+        else:
+            self._send_stream(self.state.stream_chunks(response), sse="alt=sse" in self.path)
+
+    def _create_cached_content(self, raw):
+        self.state.count("cachedContents.create", len(raw))
+        record, tokens = self.state.create_cached_content(json.loads(raw or b"{}"))
+        if record is None:
+            self._send_error(400, f"Cached content is too small. total_token_count={tokens}, min_total_token_count={CACHE_MIN_TOKENS}", "INVALID_ARGUMENT")
+            return
+        self._send_json(200, record)
+
+    def _start_upload(self, raw):
+        self.state.count("files.upload", len(raw))
+        session = uuid.uuid4().hex
+        meta = json.loads(raw or b"{}").get("file", {})
+        with self.state.lock:
+            self.state.upload_sessions[session] = meta
+        host = self.headers.get("Host")
+        self._send_json(200, {}, headers={"X-Goog-Upload-URL": f"http://{host}/upload-session/{session}"})
+
+    def _finish_upload(self, session, raw):
+        with self.state.lock:
+            meta = self.state.upload_sessions.pop(session, {})
+            name = f"files/{uuid.uuid4().hex[:12]}"
+            host = self.headers.get("Host")
+            record = {
+                "name": name,
+                "mimeType": self.headers.get("X-Goog-Upload-Header-Content-Type") or meta.get("mimeType") or "image/png",
+                "sizeBytes": str(len(raw)),
+                "uri": f"http://{host}/v1beta/{name}",
+                "state": "ACTIVE",
+                "expirationTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 48 * 3600)),
+            }
+            self.state.files[name] = {"record": record, "data": raw}
+        self.state.count("files.upload.bytes", len(raw))
+        self._send_json(200, {"file": record}, headers={"X-Goog-Upload-Status": "final"})
+
+    def _create_batch(self, model, body):
+        batch = body.get("batch", {})
+        input_config = batch.get("inputConfig", {})
+        file_name = input_config.get("fileName")
+        if file_name:
+            if file_name not in self.state.files:
+                self._send_error(404, f"File {file_name} not found.", "NOT_FOUND")
+                return
+            lines = self.state.files[file_name]["data"].decode("utf-8").splitlines()
+            requests = [json.loads(line) for line in lines if line.strip()]
+        else:
+            requests = input_config.get("requests", {}).get("requests", [])
+        name = f"batches/{uuid.uuid4().hex[:12]}"
+        with self.state.lock:
+            self.state.batches[name] = {
+                "model": model,
+                "display_name": batch.get("displayName", ""),
+                "requests": requests,
+                "file_sourced": bool(file_name),
+                "created": time.time(),
+                "state": "BATCH_STATE_PENDING",
+            }
+        self._send_json(200, self.state.batch_view(name))
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """Starts the fake server on a background thread. Returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), FakeGeminiHandler)
+    server.daemon_threads = True
+    server.state = FakeGeminiState(**options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name="fake-gemini")
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="mean seconds per generateContent call")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of calls answered with 503")
+    parser.add_argument("--block-rate", type=float, default=0.0, help="share of image calls blocked by safety")
+    parser.add_argument("--batch-queue-seconds", type=float, default=1.0)
+    parser.add_argument("--batch-run-seconds", type=float, default=1.0)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--text-seconds-per-page", type=float, default=0.0, help="extra latency per generated page prompt")
+    parser.add_argument("--story-characters", type=int, default=1, help="characters suggested with each story")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second per model before answering 429")
+    args = parser.parse_args()
+
+    server, url = start_server(
+        args.host, args.port,
+        latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, block_rate=args.block_rate,
+        batch_queue_seconds=args.batch_queue_seconds, batch_run_seconds=args.batch_run_seconds,
+        image_size=args.image_size, seed=args.seed, text_seconds_per_page=args.text_seconds_per_page,
+        story_characters=args.story_characters, rate_limit=args.rate_limit,
+    )
+    print(f"Fake Gemini listening on {url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
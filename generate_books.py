@@ -0,0 +1,290 @@
+"""
+Generates many books without the UI, from a JSONL manifest with one book per line:
+
+    {"title": "The Lost Puppy", "genre": "Children", "tone": "Heartwarming",
+     "art_style": "Watercolor illustration, soft colors", "age": "5-7", "pages": 10, "ratio": "1:1"}
+
+Only the title is required; "id" names the book's output directory (by default it is
+derived from the spec). Books run concurrently, up to --concurrency at a time, each
+going through story, character images, page prompts and illustrations. API calls of all
+books share the rate limiter of the API key. Every finished stage is checkpointed as a
+saved project (projects/), so running the same command again after an interruption
+picks each book up where it stopped and skips finished ones:
+
+    python generate_books.py books.jsonl --out books --concurrency 8
+"""
+import argparse
+import contextvars
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import image_io, projects, tracing
+from utils.clients import current_api_key, set_current_api_key
+
+BOOK_CONCURRENCY = 4
+SAVE_INTERVAL_SECONDS = 5.0
+MAX_CHARACTERS = 5
+
+DEFAULTS = {
+    "genre": "Children",
+    "tone": "Heartwarming",
+    "art_style": "Watercolor illustration, soft colors",
+    "age": "",
+    "pages": 10,
+    "ratio": "1:1",
+}
+
+
+def read_manifest(path):
+    """Book specs with defaults filled in and a stable "id" each. Raises ValueError on a bad line."""
+    specs = []
+    seen = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                spec = dict(DEFAULTS, **json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+            if not spec.get("title"):
+                raise ValueError(f"{path}:{line_number}: a title is required")
+            spec["pages"] = int(spec["pages"])
+            if spec.get("id") and not projects.is_valid_project_id(spec["id"]):
+                raise ValueError(f"{path}:{line_number}: an id may only contain letters, digits, '-' and '_'")
+            if not spec.get("id"):
+                # The same spec gets the same id on every run, which is what makes a run resumable.
+                digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+                slug = re.sub(r"[^a-z0-9]+", "-", spec["title"].lower()).strip("-")[:40] or "book"
+                spec["id"] = f"{slug}-{digest}"
+            seen[spec["id"]] = seen.get(spec["id"], 0) + 1
+            if seen[spec["id"]] > 1:
+                spec["id"] = f"{spec['id']}-{seen[spec['id']]}"
+            specs.append(spec)
+    return specs
+
+
+class BookRun:
+    """The state of one book, checkpointed to its project manifest."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.id = spec["id"]
+        saved = projects.load_project(self.id) or {}
+        self.story = saved.get("story", "")
+        self.characters = saved.get("characters", [])
+        self.story_data = saved.get("story_data")
+        self.img_paths = saved.get("img_paths", [])
+        self.errors = saved.get("errors", [])
+        self.jobs = saved.get("jobs", {})
+        self._saved_at = 0.0
+
+    def book_args(self):
+        spec = self.spec
+        return spec["title"], spec["genre"], spec["tone"], spec["art_style"], spec["pages"], spec["age"]
+
+    def save(self, min_interval=0):
+        if time.time() - self._saved_at < min_interval:
+            return
+        projects.save_project(
+            self.id,
+            title=self.spec["title"],
+            settings={name: self.spec[name] for name in DEFAULTS},
+            story=self.story,
+            characters=self.characters,
+            story_data=self.story_data,
+            img_paths=self.img_paths,
+            errors=self.errors,
+            jobs=self.jobs,
+        )
+        self._saved_at = time.time()
+
+    def log(self, message):
+        print(f"[{self.id}] {message}", flush=True)
+
+
+def write_story(book):
+    from utils.llm_utils import generate_story_prompt
+    book.log("writing story")
+    storybook = generate_story_prompt(*book.book_args())
+    book.story = storybook["story"]
+    book.characters = [{"name": char.get("name", ""), "traits": char.get("trait", ""), "image": None}
+                       for char in storybook.get("character", [])[:MAX_CHARACTERS]]
+    book.save()
+
+
+def draw_characters(book):
+    from utils.image_utils import FAILED_PAGE_RETRIES, generate_character_nanobanana
+    spec = book.spec
+    for i, char in enumerate(book.characters):
+        if char.get("image"):
+            continue
+        book.log(f"drawing character {i+1}/{len(book.characters)}")
+        # Blocked or empty responses get as many extra attempts as failed pages do.
+        for attempt in range(FAILED_PAGE_RETRIES + 1):
+            path, error = generate_character_nanobanana([f"{char['name']}, {char['traits']}"], spec["genre"], spec["tone"], spec["art_style"], i, spec["ratio"])
+            if path:
+                break
+        if not path:
+            raise RuntimeError(f"character {i+1} failed: {error}")
+        char["image"] = path
+        book.save()
+
+
+def write_page_prompts(book):
+    from utils.llm_utils import generate_page_prompt
+    book.log("writing page prompts")
+    book.story_data = generate_page_prompt(*book.book_args(), book.characters, book.story)
+    num_pages = len(book.story_data["pages"])
+    book.img_paths = [""] * num_pages
+    book.errors = [""] * num_pages
+    book.save()
+
+
+def draw_pages(book, mode, use_cache):
+    from utils import batch_jobs
+    from utils.image_utils import (cached_page_images, choose_execution_mode, failed_pages, iter_pages_nanobanana,
+                                   retry_failed_pages, submit_image_job)
+    prompts = [page["image_prompt"] for page in book.story_data["pages"]]
+    characters, ratio = book.characters, book.spec["ratio"]
+    if use_cache:
+        cached = cached_page_images(prompts, characters, ratio, page_indices=failed_pages(book.img_paths, len(prompts)))
+        book.img_paths = [path or cached_path for path, cached_path in zip(book.img_paths, cached)]
+    missing = failed_pages(book.img_paths, len(prompts))
+    if mode == "auto":
+        mode = choose_execution_mode(len(missing))
+    book.log(f"drawing {len(missing)}/{len(prompts)} pages ({mode})")
+
+    # A batch job that was submitted before an interruption is waited for, not resubmitted.
+    job_name = book.jobs.get("image_job")
+    if job_name and not batch_jobs.get_job(job_name):
+        job_name = None
+    if not job_name and missing and mode == "batch":
+        job_name, _ = submit_image_job(prompts, characters=characters, ratio=ratio, metadata={"book": book.id},
+                                    use_cache=use_cache, force_new=True, base_paths=book.img_paths)
+        book.jobs["image_job"] = job_name
+        book.save()
+    if job_name:
+        record = batch_jobs.wait_for_job(job_name)
+        if not batch_jobs.is_finished(record):
+            raise RuntimeError(f"batch job {job_name} did not finish: {record.get('poll_error', '')}")
+        book.img_paths, book.errors = list(record["img_paths"]), list(record["errors"])
+        book.jobs.pop("image_job", None)
+        book.save()
+    elif missing:
+        for i, path, error in iter_pages_nanobanana(prompts, missing, characters, ratio, use_cache=use_cache):
+            book.img_paths[i] = path
+            book.errors[i] = str(error) if error else ""
+            book.save(min_interval=SAVE_INTERVAL_SECONDS)
+        book.save()
+
+    book.img_paths, errors = retry_failed_pages(prompts, book.img_paths, book.errors, characters=characters,
+                                                ratio=ratio, use_cache=use_cache)
+    book.errors = [str(error) if error else "" for error in errors]
+    book.save()
+    failed = failed_pages(book.img_paths, len(prompts))
+    if failed:
+        raise RuntimeError(f"{len(failed)} pages have no image (pages {', '.join(str(i + 1) for i in failed)})")
+
+
+def export_book(book, book_dir):
+    """Copies the images into book_dir and writes book.json, which marks the book as done."""
+    os.makedirs(os.path.join(book_dir, "pages"), exist_ok=True)
+    os.makedirs(os.path.join(book_dir, "characters"), exist_ok=True)
+
+    def copy(src, name):
+        name += image_io.file_extension(src) or os.path.splitext(src)[1]
+        shutil.copyfile(src, os.path.join(book_dir, name))
+        return name
+
+    book_json = {
+        "id": book.id,
+        "title": book.spec["title"],
+        "book_name": book.story_data.get("book_name", ""),
+        "settings": {name: book.spec[name] for name in DEFAULTS},
+        "story": book.story,
+        "characters": [
+            {"name": char["name"], "traits": char["traits"], "image": copy(char["image"], f"characters/character_{i+1}")}
+            for i, char in enumerate(book.characters)
+        ],
+        "pages": [
+            {"text": page["text"], "image_prompt": page["image_prompt"], "image": copy(book.img_paths[i], f"pages/page_{i+1:03d}")}
+            for i, page in enumerate(book.story_data["pages"])
+        ],
+    }
+    image_io.write_atomic(os.path.join(book_dir, "book.json"), json.dumps(book_json, indent=2).encode("utf-8"))
+
+
+def run_book(spec, out_dir, mode="auto", use_cache=False):
+    """Runs the stages of one book that are not done yet. Returns "done" or "skipped"."""
+    book_dir = os.path.join(out_dir, spec["id"])
+    if os.path.exists(os.path.join(book_dir, "book.json")):
+        return "skipped"
+    book = BookRun(spec)
+    with tracing.span("cli.book", book=book.id, pages=spec["pages"]):
+        if not book.story:
+            write_story(book)
+        draw_characters(book)
+        if not book.story_data:
+            write_page_prompts(book)
+        draw_pages(book, mode, use_cache)
+        export_book(book, book_dir)
+    book.log(f"done -> {book_dir}")
+    return "done"
+
+
+def run_books(specs, out_dir, concurrency=BOOK_CONCURRENCY, mode="auto", use_cache=False):
+    """Runs the books with at most `concurrency` in flight. Returns {book_id: "done" | "skipped" | error}."""
+    from utils.image_utils import resume_image_jobs
+    # Batch jobs left running by an interrupted run are polled again before anyone waits on them.
+    resume_image_jobs()
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="book") as pool:
+        # Each book runs in a copy of this context, so the API key set here reaches every thread.
+        futures = {pool.submit(contextvars.copy_context().run, run_book, spec, out_dir, mode, use_cache): spec["id"] for spec in specs}
+        for future in as_completed(futures):
+            book_id = futures[future]
+            try:
+                results[book_id] = future.result()
+            except Exception as e:
+                print(f"[{book_id}] failed: {e}", flush=True)
+                results[book_id] = str(e)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSONL file with one book spec per line")
+    parser.add_argument("--out", default="books", help="directory that gets one subdirectory per book")
+    parser.add_argument("--concurrency", type=int, default=BOOK_CONCURRENCY, help="books in flight at once")
+    parser.add_argument("--mode", choices=["auto", "interactive", "batch"], default="auto", help="how illustrations are generated")
+    parser.add_argument("--use-cache", action="store_true", help="reuse cached images for unchanged pages")
+    parser.add_argument("--api-key", help="defaults to $GOOGLE_API_KEY or $GEMINI_API_KEY")
+    args = parser.parse_args()
+
+    if args.api_key:
+        set_current_api_key(args.api_key)
+    if not current_api_key():
+        parser.error("no API key: pass --api-key or set GOOGLE_API_KEY")
+    try:
+        specs = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    tracing.use_process_metrics_file("generate_books", keep=True)
+    started = time.time()
+    results = run_books(specs, args.out, args.concurrency, args.mode, args.use_cache)
+    failed = {book_id: result for book_id, result in results.items() if result not in ("done", "skipped")}
+    counts = {state: sum(1 for result in results.values() if result == state) for state in ("done", "skipped")}
+    print(f"{counts['done']} books done, {counts['skipped']} already done, {len(failed)} failed in {time.time() - started:.0f}s")
+    if failed:
+        print("Run the same command again to resume the failed books.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
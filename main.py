@@ -1,11 +1,14 @@
 import streamlit as st
-from utils.llm_utils import generate_page_prompt,generate_story_prompt
-from utils.image_utils import generate_image_nanobanana,generate_character_nanobanana,regenerate_image_nanobanana,regenerate_character_with_image_nanobanana,regenerate_image_with_image_nanobanana
+from utils import batch_jobs, asset_store, image_io, job_queue, projects
+from utils.clients import set_current_api_key, key_fingerprint
+from utils.export_utils import export_entries, cached_export, build_export_zip
+from utils.preview_utils import schedule_preview, preview_path
+import copy
 import uuid
 import os
-from PIL import Image
-import zipfile
-import io
+import time
+# utils.llm_utils, utils.image_utils and utils.pipeline pull in the Gemini and LangChain SDKs
+# (seconds to import), so they are imported where a generation is first started, not here.
 
 
 if "character_version" not in st.session_state:
@@ -21,13 +24,123 @@ if "generated_image_error" not in st.session_state:
 def handle_file_upload(i,CHAR_DIR):
     uploaded_file = st.session_state.get(f"image_{i}")
     if uploaded_file is not None:
-        save_path = os.path.join(CHAR_DIR, f"character_{i+1} {uuid.uuid4().hex}.jpg")
-        image = Image.open(uploaded_file)
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        image.save(save_path)
+        save_path = image_io.store_image_file(uploaded_file.getvalue(), os.path.join(CHAR_DIR, f"character_{i+1} {uuid.uuid4().hex}"))
+        schedule_preview(save_path)
+        asset_store.register(save_path, st.session_state.asset_session_id)
         st.session_state.character_data[i]["image"] = save_path
 
+def show_live_page(slot, idx, page, path, error):
+    with slot.container():
+        st.subheader(f"Page {idx+1}")
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            if path:
+                st.image(preview_path(path), caption=f"Page {idx+1} Illustration", width=400)
+            else:
+                st.warning(f"Image not available. {error}")
+        with col2:
+            st.write(page["text"])
+
+GENRE_OPTIONS = [
+    "Children", "Fantasy", "Adventure", "Sci-Fi",
+    "Mystery", "Fairy Tale", "Historical", "Comedy",
+    "Animal Story", "Friendship", "Magical Realism",
+    "Superhero", "Mythology", "Educational", "Slice of Life"
+]
+TONE_OPTIONS = [
+    "Heartwarming", "Whimsical", "Exciting", "Calm and Peaceful",
+    "Mysterious", "Inspirational", "Funny and Playful", "Adventurous",
+    "Dreamy and Magical", "Dramatic", "Hopeful", "Serious",
+    "Suspenseful", "Uplifting", "Melancholic (Gentle Sadness)"
+]
+RATIO_OPTIONS = ["1:1", "16:9", "9:16", "4:3", "3:4"]
+DEFAULT_ART_STYLE = "Watercolor illustration, soft colors"
+DEFAULT_NUM_PAGES = 10
+MAX_PAGES = 100
+# Keys of the sidebar widgets a saved book restores.
+SETTING_KEYS = ("genre_select", "genre_custom", "age", "tone_select", "tone_custom", "art_style", "ratio", "num_pages")
+
+PROJECT_SAVE_INTERVAL = 2.0
+PROJECT_STATE_KEYS = ("book_id", "generated_story", "story_data", "img_paths", "generated_image_error", "character_data",
+                      "num_characters", "generated_characters", "image_job", "queue_jobs", "project_snapshot", "story_title") + SETTING_KEYS
+
+def apply_settings(settings):
+    """Sets the sidebar widgets to a saved book's settings; must run before the widgets are drawn."""
+    for name, options in (("genre", GENRE_OPTIONS), ("tone", TONE_OPTIONS)):
+        value = settings.get(name)
+        if value:
+            # A value outside the list was typed into the custom field.
+            custom = value not in options
+            st.session_state[f"{name}_select"] = options[0] if custom else value
+            st.session_state[f"{name}_custom"] = value if custom else ""
+    for name in ("age", "art_style"):
+        if name in settings:
+            st.session_state[name] = settings[name]
+    if settings.get("ratio") in RATIO_OPTIONS:
+        st.session_state.ratio = settings["ratio"]
+    # Books written by generate_books.py store the page count as "pages".
+    num_pages = settings.get("num_pages", settings.get("pages"))
+    if num_pages:
+        st.session_state.num_pages = min(max(int(num_pages), 1), MAX_PAGES)
+
+def apply_project(project):
+    apply_settings(project["settings"])
+    st.session_state.story_title = project["title"]
+    st.session_state.generated_story = project["story"]
+    st.session_state.story_data = project["story_data"]
+    st.session_state.img_paths = project["img_paths"]
+    st.session_state.generated_image_error = project["errors"]
+    st.session_state.character_data = project["characters"]
+    st.session_state.num_characters = len(project["characters"])
+    # Unfinished jobs are picked up again through the URL, like after a refresh.
+    jobs = project["jobs"]
+    if jobs.get("image_job") and "image_job" not in st.query_params:
+        st.query_params["image_job"] = jobs["image_job"]
+    if jobs.get("queue_jobs") and "queue_job" not in st.query_params:
+        st.query_params["queue_job"] = jobs["queue_jobs"]
+
+def open_project(book_id=None):
+    """Switches the session to a saved book, or to a new empty one."""
+    for key in PROJECT_STATE_KEYS:
+        st.session_state.pop(key, None)
+    st.session_state.character_version += 1
+    st.query_params.clear()
+    if book_id:
+        st.query_params["book"] = book_id
+
+def delete_project(book_id):
+    projects.delete_project(book_id)
+    if book_id == st.session_state.book_id:
+        open_project()
+
+def save_project(story_data=None, min_interval=0):
+    """Writes the book's manifest if anything in it changed since the last save."""
+    story_data = story_data or st.session_state.story_data
+    if not st.session_state.generated_story and not story_data:
+        return
+    settings = {"genre": genre, "tone": tone, "art_style": art_style, "age": age, "num_pages": num_pages, "ratio": ratio}
+    snapshot = (st.session_state.get("story_title", ""), st.session_state.generated_story, st.session_state.character_data, story_data,
+                st.session_state.img_paths, st.session_state.generated_image_error, st.session_state.image_job, st.session_state.queue_jobs, settings)
+    saved = st.session_state.get("project_snapshot")
+    if saved and (saved[0] == snapshot or time.time() - saved[1] < min_interval):
+        return
+    projects.save_project(
+        st.session_state.book_id,
+        title=snapshot[0],
+        settings=settings,
+        story=st.session_state.generated_story,
+        characters=st.session_state.character_data,
+        story_data=story_data,
+        img_paths=st.session_state.img_paths,
+        errors=st.session_state.generated_image_error,
+        jobs={"image_job": st.session_state.image_job, "queue_jobs": st.session_state.queue_jobs},
+    )
+    st.session_state.project_snapshot = (copy.deepcopy(snapshot), time.time())
+    st.query_params["book"] = st.session_state.book_id
+
+def clear_export_request():
+    st.session_state.export_requested = False
+
 def all_characters_valid(characters):
     for c in characters:
         if not c.get("name") or not c.get("traits") or not c.get("image"):
@@ -48,95 +161,342 @@ st.set_page_config(page_title="AI Storybook Page", layout="wide")
 
 if "character_version" not in st.session_state:
     st.session_state.character_version = 0
+if "book_id" not in st.session_state:
+    # A saved book is reopened from the URL, e.g. after a refresh or a server restart.
+    requested = st.query_params.get("book")
+    if requested and not projects.is_valid_project_id(requested):
+        # Not a name this app hands out; a new book is started instead of touching that path.
+        st.query_params.pop("book")
+        requested = None
+    st.session_state.book_id = requested or uuid.uuid4().hex
+    project = projects.load_project(requested) if requested else None
+    if project:
+        apply_project(project)
 if "generated_story" not in st.session_state:
     st.session_state.generated_story = ""
 if "story_data" not in st.session_state:
     st.session_state.story_data = None
 if "img_paths" not in st.session_state:
     st.session_state.img_paths = []
+if "image_job" not in st.session_state:
+    # The job name is mirrored in the URL so a browser refresh can pick the job up again.
+    st.session_state.image_job = st.query_params.get("image_job")
+    restored = batch_jobs.get_job(st.session_state.image_job) if st.session_state.image_job else None
+    if restored and not st.session_state.story_data:
+        st.session_state.story_data = restored.get("metadata", {}).get("story_data")
+if "queue_jobs" not in st.session_state:
+    # Jobs handed to worker.py; mirrored in the URL like image_job.
+    st.session_state.queue_jobs = st.query_params.get_all("queue_job")
+    st.session_state.queue_notices = []
+if "asset_session_id" not in st.session_state:
+    st.session_state.asset_session_id = uuid.uuid4().hex
+    asset_store.start_gc_thread()
+
+# Tell the asset store which files this session still shows; everything else may be collected.
+session_assets = sorted(
+    [p for p in st.session_state.img_paths if p]
+    + [c["image"] for c in st.session_state.character_data if c.get("image")]
+)
+# Re-reported hourly even when unchanged, which keeps a long-lived session from looking abandoned.
+if st.session_state.get("reported_assets") != session_assets or time.time() - st.session_state.get("reported_at", 0) > 3600:
+    asset_store.set_session_references(st.session_state.asset_session_id, st.session_state.book_id, session_assets)
+    st.session_state.reported_assets = session_assets
+    st.session_state.reported_at = time.time()
+
+def use_session_api_key():
+    # Every rerun runs in a fresh thread, and fragment reruns skip the sidebar that sets the key.
+    set_current_api_key(st.session_state.get("GOOGLE_API_KEY", ""))
+
+@st.fragment(run_every=2)
+def show_image_job_status():
+    use_session_api_key()
+    job_name = st.session_state.image_job
+    record = batch_jobs.get_job(job_name)
+    if record is None:
+        st.session_state.image_job = None
+        st.query_params.pop("image_job", None)
+        return
+    if batch_jobs.is_finished(record):
+        from utils.image_utils import FAILED_PAGE_RETRIES, failed_pages, submit_image_job
+        metadata = record.get("metadata", {})
+        failed = failed_pages(record["img_paths"])
+        attempt = metadata.get("retry_attempt", 0)
+        story_data = metadata.get("story_data") or st.session_state.story_data
+        if failed and attempt < FAILED_PAGE_RETRIES and story_data:
+            # Follow-up batch with only the failed or blocked pages; the rest of the book is kept.
+            try:
+                retry_job, _ = submit_image_job(
+                    [page["image_prompt"] for page in story_data["pages"]],
+                    characters=st.session_state.character_data,
+                    ratio=metadata.get("ratio", "1:1"),
+                    metadata=dict(metadata, retry_attempt=attempt + 1),
+                    use_cache=metadata.get("use_cache", False),
+                    force_new=True,
+                    base_paths=record["img_paths"]
+                )
+            except Exception as e:
+                print(f"Retrying failed pages of {job_name} failed: {e}")
+                retry_job = None
+            if retry_job:
+                st.session_state.image_job = retry_job
+                st.query_params["image_job"] = retry_job
+                st.info(f"🔁 Retrying {len(failed)} failed pages (attempt {attempt + 1}/{FAILED_PAGE_RETRIES})...")
+                return
+        st.session_state.img_paths = record["img_paths"]
+        st.session_state.generated_image_error = record["errors"]
+        st.session_state.image_job = None
+        st.query_params.pop("image_job", None)
+        st.session_state.character_version += 1
+        st.session_state.images_ready_notice = True
+        st.rerun()
+    if record.get("poll_error"):
+        st.warning(f"Lost contact with the image job, retrying after API key is entered. {record['poll_error']}")
+    state = (record.get("state") or "JOB_STATE_PENDING").replace("JOB_STATE_", "").lower()
+    st.info(f"🎨 Generating illustrations ({record.get('num_requests', 0)} pages)... job is {state}, you can keep working meanwhile.")
+
+def enqueue_job(kind, params):
+    job_id = job_queue.enqueue(kind, params, api_key, key_fingerprint(api_key))
+    st.session_state.queue_jobs.append(job_id)
+    sync_queue_params()
+    return job_id
+
+def sync_queue_params():
+    if st.session_state.queue_jobs:
+        st.query_params["queue_job"] = st.session_state.queue_jobs
+    else:
+        st.query_params.pop("queue_job", None)
+
+def apply_queue_result(record):
+    result = record.get("result") or {}
+    params = record["params"]
+    if record["state"] != "succeeded":
+        st.session_state.queue_notices.append(f"{record['kind'].capitalize()} job failed: {record.get('error')}")
+    elif record["kind"] == "character":
+        i = params["index"]
+        if result.get("path") and i < len(st.session_state.character_data):
+            st.session_state.character_data[i]["image"] = result["path"]
+            st.session_state.character_version += 1
+        elif not result.get("path"):
+            st.session_state.queue_notices.append(f"Failed to generate image for Character {i+1}. {result.get('error', '')}")
+    elif record["kind"] == "images":
+        st.session_state.story_data = result["story_data"]
+        st.session_state.img_paths = result["img_paths"]
+        st.session_state.generated_image_error = result["errors"]
+        st.session_state.character_version += 1
+        st.session_state.images_ready_notice = True
+
+@st.fragment(run_every=2)
+def show_queue_jobs():
+    use_session_api_key()
+    finished = []
+    for job_id in st.session_state.queue_jobs:
+        record = job_queue.get_job(job_id)
+        if record is None or job_queue.is_finished(record):
+            finished.append((job_id, record))
+            continue
+        label = "Illustrations" if record["kind"] == "images" else f"{record['kind'].capitalize()} image"
+        if record["state"] == "queued":
+            st.info(f"⏳ {label}: waiting for a worker ({job_queue.queue_position(job_id)} jobs ahead)...")
+            continue
+        if record["state"] == job_queue.WAITING_STATE:
+            st.info(f"⏳ {label}: batch job submitted, waiting for its results...")
+            continue
+        progress = record.get("progress") or {}
+        if progress.get("total") and progress.get("done") is not None:
+            st.progress(progress["done"] / progress["total"], text=f"🎨 {label}: {progress['done']}/{progress['total']} ready")
+        else:
+            st.info(f"🎨 {label}: running ({progress.get('stage', 'starting')})...")
+    if finished:
+        for job_id, record in finished:
+            st.session_state.queue_jobs.remove(job_id)
+            if record is not None:
+                apply_queue_result(record)
+        sync_queue_params()
+        st.rerun()
+
+READER_WINDOWS = [5, 10, 20, 50]
+
+def show_reader_image(slot, i):
+    with slot.container():
+        if i-1 < len(st.session_state.img_paths) and st.session_state.img_paths[i-1]:
+            st.image(preview_path(st.session_state.img_paths[i-1]), caption=f"Page {i} Illustration", width=400)
+        else:
+            st.warning(f"Image not available. {st.session_state.generated_image_error[i-1]}")
+
+@st.fragment
+def show_reader_page(i):
+    """One page of the reader. Its prompt edits and regenerations rerun only this page."""
+    use_session_api_key()
+    from utils.image_utils import regenerate_image_nanobanana, regenerate_image_with_image_nanobanana
+    page = st.session_state.story_data["pages"][i-1]
+    st.subheader(f"Page {i}")
+
+    col1, col2 = st.columns([1, 1])
+
+    # Regenerated images are drawn into this slot directly, without rerunning the page.
+    image_slot = col1.empty()
+    show_reader_image(image_slot, i)
+
+    with col2:
+        st.write(page["text"])
+        
+        new_prompt = st.text_area(f"Image Prompt for Page {i}", value=page['image_prompt'], key=f"prompt_{i}_{st.session_state.character_version}")
+        
+        if new_prompt != page['image_prompt']:
+            st.session_state.story_data["pages"][i-1]["image_prompt"] = new_prompt
+        
+        force_new = st.checkbox("Force new variant", value=not use_image_cache, disabled=not use_image_cache, key=f"force_new_{i}")
+        if st.button(f"🔄 Re-generate Image {i}", key=f"regen_{i}"):
+            with st.spinner(f"Regenerating image for Page {i}..."):
+                
+                new_img_path,error= regenerate_image_nanobanana(
+                    new_prompt, 
+                    characters=st.session_state.character_data, 
+                    ratio=ratio,
+                    use_cache=use_image_cache,
+                    force_new=force_new
+                )
+                if new_img_path:
+                    if i-1 < len(st.session_state.img_paths):
+                        st.session_state.img_paths[i-1] = new_img_path
+                    else:
+                        st.session_state.img_paths.append(new_img_path)
+                    show_reader_image(image_slot, i)
+                else:
+                    st.error(f"Failed to regenerate image. {error}")
+
+        if st.button(f"🔄 Re-generate with Original Image {i}", key=f"regen_img_{i}"):
+            with st.spinner(f"Regenerating image for Page {i} using original image..."):
+                
+                current_img_path = st.session_state.img_paths[i-1]
+                new_img_path,error = regenerate_image_with_image_nanobanana(
+                    new_prompt, 
+                    original_image_path=current_img_path,
+                    characters=st.session_state.character_data, 
+                    ratio=ratio
+                )
+                if new_img_path:
+                    if i-1 < len(st.session_state.img_paths):
+                        st.session_state.img_paths[i-1] = new_img_path
+                    else:
+                        st.session_state.img_paths.append(new_img_path)
+                    show_reader_image(image_slot, i)
+                else:
+                    st.error(f"Failed to regenerate image. {error}")
+    # Fragment reruns skip the end of the script, so this page's changes are saved here.
+    save_project()
 
 with st.sidebar:
     api_key = st.text_input("Enter your API Key:", type="password")
     if api_key:
         st.session_state["GOOGLE_API_KEY"] = api_key
-        os.environ["GOOGLE_API_KEY"] = api_key 
+        set_current_api_key(api_key)
         st.success("API Key successfully loaded for this session!")
+        if not st.session_state.get("jobs_resumed"):
+            if batch_jobs.unfinished_jobs(key_fingerprint(api_key)):
+                from utils.image_utils import resume_image_jobs
+                resume_image_jobs()
+            st.session_state.jobs_resumed = True
 
     st.header("🛠 Story Configuration")
 
     with st.expander("📌 Story Information", expanded=True):
-        title = st.text_input("Story Title", placeholder="The Lost Puppy")
+        title = st.text_input("Story Title", placeholder="The Lost Puppy", key="story_title")
 
-        genre_options = [
-            "Children", "Fantasy", "Adventure", "Sci-Fi",
-            "Mystery", "Fairy Tale", "Historical", "Comedy",
-            "Animal Story", "Friendship", "Magical Realism",
-            "Superhero", "Mythology", "Educational", "Slice of Life"
-        ]
-        genre_select = st.selectbox("Genre", genre_options, index=0)
-        genre_custom = st.text_input("Custom Genre (optional)")
+        genre_select = st.selectbox("Genre", GENRE_OPTIONS, index=0, key="genre_select")
+        genre_custom = st.text_input("Custom Genre (optional)", key="genre_custom")
 
         genre = genre_custom if genre_custom else genre_select
-        age = st.text_input("Target Age / Reading Level", placeholder="5-7")
+        age = st.text_input("Target Age / Reading Level", placeholder="5-7", key="age")
 
     with st.expander("🎭 Tone & Writing Style", expanded=False):
-        tone_options = [
-            "Heartwarming", "Whimsical", "Exciting", "Calm and Peaceful",
-            "Mysterious", "Inspirational", "Funny and Playful", "Adventurous",
-            "Dreamy and Magical", "Dramatic", "Hopeful", "Serious",
-            "Suspenseful", "Uplifting", "Melancholic (Gentle Sadness)"
-        ]
-        tone_select = st.selectbox("Tone", tone_options, index=0)
-        tone_custom = st.text_input("Custom Tone (optional)")
+        tone_select = st.selectbox("Tone", TONE_OPTIONS, index=0, key="tone_select")
+        tone_custom = st.text_input("Custom Tone (optional)", key="tone_custom")
 
         tone = tone_custom if tone_custom else tone_select
-        art_style = st.text_input("Art Style", "Watercolor illustration, soft colors")
+        # Defaults go through session state so a restored book's settings don't conflict with them.
+        st.session_state.setdefault("art_style", DEFAULT_ART_STYLE)
+        art_style = st.text_input("Art Style", key="art_style")
 
     with st.expander("🖼 Page Settings", expanded=False):
         ratio = st.selectbox(
             "Image Aspect Ratio",
-            ["1:1", "16:9", "9:16", "4:3", "3:4"],
-            index=0
+            RATIO_OPTIONS,
+            index=0,
+            key="ratio"
         )
+        st.session_state.setdefault("num_pages", DEFAULT_NUM_PAGES)
         num_pages = st.number_input(
             "Number of Pages", 
             min_value=1, 
-            max_value=100, 
-            value=10,  
-            step=1
+            max_value=MAX_PAGES, 
+            step=1,
+            key="num_pages"
         )
+        mode_options = {"Auto": "auto", "Interactive (fast)": "interactive", "Batch (cheaper, slower)": "batch"}
+        illustration_mode = mode_options[st.selectbox(
+            "Illustration Mode",
+            list(mode_options),
+            index=0,
+            help="Interactive generates pages concurrently and finishes in seconds. Batch costs less but can queue for minutes. Auto uses interactive for short books."
+        )]
+        use_image_cache = st.toggle(
+            "Reuse cached images",
+            value=False,
+            help="Serve pages whose prompt, characters and ratio are unchanged from the local image cache instead of generating them again."
+        )
+
+    saved_books = projects.list_projects()
+    if saved_books:
+        with st.expander("📂 Saved Books", expanded=False):
+            titles = {book_id: f"{info['title']} ({info['pages']} pages, {time.strftime('%Y-%m-%d %H:%M', time.localtime(info['updated_at']))})"
+                      for book_id, info in saved_books}
+            chosen = st.selectbox("Book", list(titles), format_func=titles.get)
+            col1, col2 = st.columns(2)
+            col1.button("Open", on_click=open_project, args=[chosen], disabled=chosen == st.session_state.book_id)
+            col2.button("🗑 Delete", on_click=delete_project, args=[chosen])
 
 
 tab1, tab2 = st.tabs(["✍️ Create Story", "📖 Read Storybook"])
+with tab2:
+    # Filled page by page while illustrations stream in, cleared once the full reader renders.
+    live_pages = st.empty()
 
 with tab1:
     st.header("1. Generate Story Text")
-    if st.button("✨ Generate Story", key="generate_story_button"):
+    generate_story = st.button("✨ Generate Story", key="generate_story_button")
+
+    st.subheader("📝 Generated Story (Editable)")
+    story_area = st.empty()
+    if generate_story:
         if not api_key:
             st.warning("Please enter api key.")
             st.stop()
-        with st.spinner("Generating story..."):
-            try:
-                storybook = generate_story_prompt(title, genre, tone, art_style, num_pages, age)
-                st.session_state.generated_story = storybook.get("story", "")
-                st.session_state.generated_characters = storybook.get("character", [])[:5]
-                st.session_state.character_data = []
-                for char in st.session_state.generated_characters:
-                    st.session_state.character_data.append({
-                        "name": char.get("name", ""),
-                        "traits": char.get("trait", ""),
-                        "image": None
-                    })
-                st.session_state.num_characters = len(st.session_state.generated_characters)
-                st.session_state.character_version += 1
-            except Exception as e:
-                st.error(f"Story generation failed: {e}")
-                st.session_state.generated_story = ""
-                st.session_state.generated_characters = []
-
-
-    st.subheader("📝 Generated Story (Editable)")
-    st.text_area(
+        from utils.llm_utils import stream_story_prompt
+        try:
+            # The story is shown as it streams in; the editable area replaces it once the characters are in too.
+            # Every click asks for a new story, so the response cache is bypassed.
+            storybook = None
+            for storybook in stream_story_prompt(title, genre, tone, art_style, num_pages, age, use_cache=False):
+                story_area.container(height=300).markdown(storybook.get("story", "") + " ▌")
+            st.session_state.book_id = uuid.uuid4().hex
+            st.session_state.generated_story = storybook.get("story", "")
+            st.session_state.generated_characters = storybook.get("character", [])[:5]
+            st.session_state.character_data = []
+            for char in st.session_state.generated_characters:
+                st.session_state.character_data.append({
+                    "name": char.get("name", ""),
+                    "traits": char.get("trait", ""),
+                    "image": None
+                })
+            st.session_state.num_characters = len(st.session_state.generated_characters)
+            st.session_state.character_version += 1
+        except Exception as e:
+            st.error(f"Story generation failed: {e}")
+            st.session_state.generated_story = ""
+            st.session_state.generated_characters = []
+
+    story_area.text_area(
         "Edit the story here:",
         key="generated_story", 
         height=300
@@ -155,7 +515,7 @@ with tab1:
             
             char_name = st.text_input(f"Character {i+1} Name", value=existing.get("name", ""), key=f"name_{i}_{st.session_state.character_version}",on_change=update_character_name,args=[i])
             char_traits = st.text_area(f"Character {i+1} Traits / Description", value=existing.get("traits", ""), key=f"traits_{i}_{st.session_state.character_version}",on_change=update_character_traits,args=[i])
-            char_image_upload = st.file_uploader(f"Upload Character {i+1} Image (optional)", type=["png","jpg"], key=f"image_{i}",on_change=handle_file_upload,args=[i,CHAR_DIR])
+            char_image_upload = st.file_uploader(f"Upload Character {i+1} Image (optional)", type=["png","jpg","jpeg","webp"], key=f"image_{i}",on_change=handle_file_upload,args=[i,CHAR_DIR])
 
             if st.button(f"Generate Character {i+1} Image via Nanobanana", key=f"generate_{i}"):
                 if not api_key:
@@ -164,7 +524,11 @@ with tab1:
                 if not char_name and not char_traits:
                     st.warning("Please enter a name or traits to generate the character image.")
                     
+                elif job_queue.workers_available():
+                    enqueue_job("character", {"description": f"{char_name}, {char_traits}", "genre": genre, "tone": tone,
+                                              "art_style": art_style, "index": i, "ratio": ratio})
                 else:
+                    from utils.image_utils import generate_character_nanobanana
                     with st.spinner(f"Generating image for Character {i+1}..."):
                         char_image_path,error= generate_character_nanobanana([f"{char_name}, {char_traits}"], genre,tone,art_style,i,ratio=ratio)
                         if char_image_path:
@@ -176,6 +540,7 @@ with tab1:
                 if not st.session_state.character_data[i]["image"]:
                     st.warning("Ensure to have a picture")
                 else:
+                    from utils.image_utils import regenerate_character_with_image_nanobanana
                     with st.spinner(f"Regenerating image for Character {i+1} using original image..."):
                         new_char_path,error= regenerate_character_with_image_nanobanana(
                             character_description=f"{char_name}, {char_traits}",
@@ -192,7 +557,7 @@ with tab1:
                         else:
                             st.error(f"Failed to regenerate image. {error}")
             if st.session_state.character_data[i]["image"]:
-                st.image(st.session_state.character_data[i]["image"], caption=f"{char_name if char_name else 'Generated Character'} Image", width=300)
+                st.image(preview_path(st.session_state.character_data[i]["image"]), caption=f"{char_name if char_name else 'Generated Character'} Image", width=300)
 
     if st.button("Clear All Characters"):
         st.session_state.character_data = []
@@ -224,108 +589,162 @@ with tab1:
                 st.warning("Please complete ALL character fields (name, traits, and image).")
                 st.stop()
 
-        with st.spinner("🧠 Generating image prompt..."):
-            st.session_state.story_data = generate_page_prompt(
-                            title, 
-                            genre, 
-                            tone, 
-                            art_style, 
-                            num_pages,
-                            age,
-                            st.session_state.character_data,
-                            st.session_state.generated_story
-                        )
-
-        with st.spinner("🎨 Generating illustrations..."):
+        from utils.llm_utils import generate_page_prompt
+        from utils.pipeline import iter_book_pipeline
+        from utils.image_utils import FAILED_PAGE_RETRIES, failed_pages, iter_pages_nanobanana, submit_image_job, choose_execution_mode
+        mode = illustration_mode
+        if mode == "auto":
+            mode = choose_execution_mode(num_pages)
+        if job_queue.workers_available():
+            # A worker process runs the whole stage; this session only polls it.
+            enqueue_job("images", {
+                "title": title, "genre": genre, "tone": tone, "art_style": art_style, "num_pages": num_pages, "age": age,
+                "characters": st.session_state.character_data, "story": st.session_state.generated_story,
+                "ratio": ratio, "mode": mode, "use_cache": use_image_cache,
+            })
+        elif mode == "interactive":
+            # Page prompts are written in small groups and each page is illustrated as soon as its prompt exists.
+            story_pages = [None] * num_pages
+            st.session_state.img_paths = [""] * num_pages
+            st.session_state.generated_image_error = ["Still generating..."] * num_pages
+            progress = st.progress(0.0, text="🧠 Writing pages... illustrations appear in the 'Read Storybook' tab as they finish.")
+            with live_pages.container():
+                st.header("📚 Story Output")
+                slots = [st.empty() for _ in range(num_pages)]
+            for idx, slot in enumerate(slots):
+                slot.info(f"Page {idx+1}: writing...")
+            done = 0
+            book_name = ""
+            for event in iter_book_pipeline(title, genre, tone, art_style, num_pages, age, st.session_state.character_data, st.session_state.generated_story, ratio=ratio, use_cache=use_image_cache):
+                if event[0] == "pages":
+                    _, first, name, group = event
+                    if name and (first == 0 or not book_name):
+                        book_name = name
+                    story_pages[first:first + len(group)] = group
+                    for idx in range(first, first + len(group)):
+                        slots[idx].info(f"Page {idx+1}: illustration in progress...")
+                    continue
+                _, idx, path, error = event
+                done += 1
+                st.session_state.img_paths[idx] = path
+                st.session_state.generated_image_error[idx] = error
+                show_live_page(slots[idx], idx, story_pages[idx], path, error)
+                progress.progress(done / num_pages, text=f"🎨 {done}/{num_pages} illustrations ready")
+                save_project({"book_name": book_name, "pages": story_pages}, min_interval=PROJECT_SAVE_INTERVAL)
+            st.session_state.story_data = {"book_name": book_name, "pages": story_pages}
+            image_prompts = [page["image_prompt"] for page in story_pages]
+            # Follow-up passes re-run only the failed or blocked pages.
+            for attempt in range(1, FAILED_PAGE_RETRIES + 1):
+                failed = [idx for idx in failed_pages(st.session_state.img_paths) if image_prompts[idx]]
+                if not failed:
+                    break
+                progress.progress(1.0, text=f"🔁 Retrying {len(failed)} failed pages (attempt {attempt}/{FAILED_PAGE_RETRIES})...")
+                for idx, path, error in iter_pages_nanobanana(image_prompts, failed, characters=st.session_state.character_data, ratio=ratio, use_cache=use_image_cache):
+                    st.session_state.img_paths[idx] = path
+                    st.session_state.generated_image_error[idx] = error
+                    show_live_page(slots[idx], idx, story_pages[idx], path, error)
+            progress.empty()
+            live_pages.empty()
+            st.session_state.character_version += 1
+            st.session_state.images_ready_notice = True
+        else:
+            with st.spinner("🧠 Generating image prompt..."):
+                st.session_state.story_data = generate_page_prompt(
+                                title, 
+                                genre, 
+                                tone, 
+                                art_style, 
+                                num_pages,
+                                age,
+                                st.session_state.character_data,
+                                st.session_state.generated_story
+                            )
             image_prompts = [page["image_prompt"] for page in st.session_state.story_data["pages"]]
-            st.session_state.img_paths,st.session_state.generated_image_error = generate_image_nanobanana(image_prompts, characters=st.session_state.character_data,ratio=ratio)
-        
+            with st.spinner("🎨 Submitting illustrations..."):
+                st.session_state.image_job, cached_paths = submit_image_job(
+                    image_prompts,
+                    characters=st.session_state.character_data,
+                    ratio=ratio,
+                    metadata={"story_data": st.session_state.story_data, "ratio": ratio, "use_cache": use_image_cache},
+                    use_cache=use_image_cache
+                )
+            if st.session_state.image_job:
+                st.query_params["image_job"] = st.session_state.image_job
+            else:
+                # Every page was served from the image cache.
+                st.session_state.img_paths = cached_paths
+                st.session_state.generated_image_error = [""] * len(image_prompts)
+                st.session_state.character_version += 1
+                st.session_state.images_ready_notice = True
+
+    if st.session_state.queue_jobs:
+        show_queue_jobs()
+    for notice in st.session_state.queue_notices:
+        st.error(notice)
+    st.session_state.queue_notices = []
+    if st.session_state.image_job:
+        show_image_job_status()
+    elif st.session_state.pop("images_ready_notice", False):
         st.success("Images generated! Switch to the 'Read Storybook' tab to view them.")
-        st.session_state.character_version += 1
 
 with tab2:
     if st.session_state.story_data and st.session_state.img_paths:
+        from utils.image_utils import failed_pages, retry_failed_pages
         st.header("📥 Download")
         download_option = st.radio("Choose download:", ["All", "Story Images", "Character Images"], horizontal=True)
         
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w") as zf:
-            if download_option in ["All", "Story Images"]:
-                for i, path in enumerate(st.session_state.img_paths):
-                    if os.path.exists(path):
-                        ext = os.path.splitext(path)[1]
-                        zf.write(path, arcname=f"story_images/{i+1}{ext}")
-            
-            if download_option in ["All", "Character Images"]:
-                for i, char in enumerate(st.session_state.character_data):
-                    path = char.get("image")
-                    if path and os.path.exists(path):
-                        ext = os.path.splitext(path)[1]
-                        zf.write(path, arcname=f"characters/{i+1}{ext}")
-        
-        st.download_button(
-            label="Download ZIP",
-            data=zip_buffer.getvalue(),
-            file_name="storybook_assets.zip",
-            mime="application/zip"
-        )
+        entries = export_entries(st.session_state.img_paths, st.session_state.character_data, download_option)
+        zip_path = cached_export(entries) if st.session_state.get("export_requested") else None
+        if zip_path is None:
+            if st.button("📦 Prepare ZIP", disabled=not entries):
+                with st.spinner("Packing assets..."):
+                    zip_path = build_export_zip(entries)
+                st.session_state.export_requested = True
+        if zip_path:
+            # The archive is only read while the download button is shown, not on every rerun.
+            with open(zip_path, "rb") as zip_file:
+                st.download_button(
+                    label="Download ZIP",
+                    data=zip_file,
+                    file_name="storybook_assets.zip",
+                    mime="application/zip",
+                    on_click=clear_export_request
+                )
         st.divider()
 
         st.header("📚 Story Output")
-        
-        for i, page in enumerate(st.session_state.story_data["pages"], start=1):
-            st.subheader(f"Page {i}")
-
-            col1, col2 = st.columns([1, 1])
-
-            with col1:
-                if i-1 < len(st.session_state.img_paths) and st.session_state.img_paths[i-1]:
-                    st.image(st.session_state.img_paths[i-1], caption=f"Page {i} Illustration", width=400)
-                else:
-                    st.warning(f"Image not available. {st.session_state.generated_image_error[i-1]}")
-
-            with col2:
-                st.write(page["text"])
-                
-                new_prompt = st.text_area(f"Image Prompt for Page {i}", value=page['image_prompt'], key=f"prompt_{i}_{st.session_state.character_version}")
-                
-                if new_prompt != page['image_prompt']:
-                    st.session_state.story_data["pages"][i-1]["image_prompt"] = new_prompt
-                
-                if st.button(f"🔄 Re-generate Image {i}", key=f"regen_{i}"):
-                    with st.spinner(f"Regenerating image for Page {i}..."):
-                        
-                        new_img_path,error= regenerate_image_nanobanana(
-                            new_prompt, 
-                            characters=st.session_state.character_data, 
-                            ratio=ratio
-                        )
-                        if new_img_path:
-                            if i-1 < len(st.session_state.img_paths):
-                                st.session_state.img_paths[i-1] = new_img_path
-                            else:
-                                st.session_state.img_paths.append(new_img_path)
-                            st.rerun()
-                        else:
-                            st.error(f"Failed to regenerate image. {error}")
 
-                if st.button(f"🔄 Re-generate with Original Image {i}", key=f"regen_img_{i}"):
-                    with st.spinner(f"Regenerating image for Page {i} using original image..."):
-                        
-                        current_img_path = st.session_state.img_paths[i-1]
-                        new_img_path,error = regenerate_image_with_image_nanobanana(
-                            new_prompt, 
-                            original_image_path=current_img_path,
-                            characters=st.session_state.character_data, 
-                            ratio=ratio
-                        )
-                        if new_img_path:
-                            if i-1 < len(st.session_state.img_paths):
-                                st.session_state.img_paths[i-1] = new_img_path
-                            else:
-                                st.session_state.img_paths.append(new_img_path)
-                            st.rerun()
-                        else:
-                            st.error(f"Failed to regenerate image. {error}")
+        failed = failed_pages(st.session_state.img_paths, len(st.session_state.story_data["pages"]))
+        if failed and not st.session_state.image_job:
+            if st.button(f"🔁 Retry {len(failed)} failed pages", key="retry_failed_pages"):
+                with st.spinner(f"Regenerating {len(failed)} pages..."):
+                    st.session_state.img_paths, st.session_state.generated_image_error = retry_failed_pages(
+                        [page["image_prompt"] for page in st.session_state.story_data["pages"]],
+                        st.session_state.img_paths,
+                        st.session_state.generated_image_error,
+                        characters=st.session_state.character_data,
+                        ratio=ratio,
+                        retries=1,
+                        use_cache=use_image_cache
+                    )
+                st.session_state.character_version += 1
+                st.rerun()
+        
+        pages = st.session_state.story_data["pages"]
+        window, first = len(pages), 0
+        if len(pages) > READER_WINDOWS[0]:
+            col1, col2 = st.columns([1, 3])
+            window = col1.selectbox("Pages per view", READER_WINDOWS, index=1, key="reader_window")
+            first = col2.selectbox(
+                "Pages",
+                range(0, len(pages), window),
+                format_func=lambda start: f"{start+1}–{min(start + window, len(pages))}",
+                key=f"reader_first_{window}"
+            )
+        for i in range(first + 1, min(first + window, len(pages)) + 1):
+            show_reader_page(i)
     else:
         st.info("Go to the 'Create Story' tab to generate your storybook first!")
+
+# Everything this run changed is in the manifest before the next interaction.
+save_project()
@@ -0,0 +1,226 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from utils import preview_utils
+
+ASSET_DB = os.path.join(".cache", "assets.sqlite3")
+ASSET_DIRS = ("images", "characters")
+# Files are kept this long after they were written and after the last reference to them
+# went away, so results still on their way into a session (e.g. a finished batch job) and
+# images a session only just stopped showing are never collected.
+GC_GRACE_SECONDS = 24 * 60 * 60
+GC_INTERVAL_SECONDS = 15 * 60
+# A session that hasn't reported its references for this long is considered abandoned.
+SESSION_TTL_SECONDS = 3 * 24 * 60 * 60
+SESSION_QUOTA_BYTES = 500 * 1024 * 1024
+SESSION_QUOTA_FILES = 1000
+
+_gc_thread = None
+_gc_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _connect():
+    """Yields a connection, committing on success and always closing it."""
+    os.makedirs(os.path.dirname(ASSET_DB), exist_ok=True)
+    conn = sqlite3.connect(ASSET_DB, timeout=30)
+    try:
+        with conn:
+            _init_schema(conn)
+            yield conn
+    finally:
+        conn.close()
+
+
+def _init_schema(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS assets (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            owner TEXT
+        );
+        CREATE TABLE IF NOT EXISTS refs (
+            path TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            book_id TEXT,
+            PRIMARY KEY (path, session_id)
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS assets_owner ON assets (owner);
+        CREATE INDEX IF NOT EXISTS refs_session ON refs (session_id);
+    """)
+    # Added after the first release; stores created before it get the column here.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(assets)")}
+    if "unreferenced_since" not in columns:
+        try:
+            conn.execute("ALTER TABLE assets ADD COLUMN unreferenced_since REAL")
+        except sqlite3.OperationalError:
+            # Another connection added it first.
+            pass
+
+
+def _norm(path):
+    return os.path.normpath(path)
+
+
+def register(path, session_id=None):
+    """Records a newly written asset. The first session that references it becomes its owner."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO assets (path, size, created_at, owner) VALUES (?, ?, ?, ?)",
+            (_norm(path), size, time.time(), session_id),
+        )
+
+
+def set_session_references(session_id, book_id, paths):
+    """
+    Replaces the set of assets a session currently shows (pages, characters) and
+    enforces the session's quota by deleting its oldest unreferenced files.
+    """
+    paths = sorted({_norm(p) for p in paths if p})
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("INSERT OR REPLACE INTO sessions (session_id, last_seen) VALUES (?, ?)", (session_id, now))
+        conn.execute("DELETE FROM refs WHERE session_id = ?", (session_id,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO refs (path, session_id, book_id) VALUES (?, ?, ?)",
+            [(p, session_id, book_id) for p in paths],
+        )
+        conn.executemany(
+            "UPDATE assets SET owner = ? WHERE path = ? AND owner IS NULL",
+            [(session_id, p) for p in paths],
+        )
+        removed = _enforce_quota(conn, session_id)
+    _delete_files(removed)
+
+
+def set_project_references(project_id, paths):
+    """
+    Replaces the assets a saved project keeps. Unlike a session's, these references don't
+    expire and don't count against a quota; they last until the project is deleted.
+    """
+    owner = f"project:{project_id}"
+    paths = sorted({_norm(p) for p in paths if p})
+    with _connect() as conn:
+        conn.execute("DELETE FROM refs WHERE session_id = ?", (owner,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO refs (path, session_id, book_id) VALUES (?, ?, ?)",
+            [(p, owner, project_id) for p in paths],
+        )
+
+
+def _unreferenced(conn, where, params):
+    return conn.execute(
+        f"SELECT path, size FROM assets WHERE {where} "
+        "AND NOT EXISTS (SELECT 1 FROM refs WHERE refs.path = assets.path) "
+        "ORDER BY created_at",
+        params,
+    ).fetchall()
+
+
+def _enforce_quota(conn, session_id):
+    count, total = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM assets WHERE owner = ?", (session_id,)
+    ).fetchone()
+    removed = []
+    for path, size in _unreferenced(conn, "owner = ?", (session_id,)):
+        if count <= SESSION_QUOTA_FILES and total <= SESSION_QUOTA_BYTES:
+            break
+        removed.append(path)
+        count -= 1
+        total -= size
+    conn.executemany("DELETE FROM assets WHERE path = ?", [(p,) for p in removed])
+    return removed
+
+
+def _delete_files(paths):
+    for path in paths:
+        # Previews are named by the content hash, so they are found before the file goes.
+        preview_utils.remove_previews(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _adopt_untracked(conn):
+    # Files written before the store existed (or by older code) get tracked from their mtime.
+    known = {row[0] for row in conn.execute("SELECT path FROM assets")}
+    for directory in ASSET_DIRS:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            path = _norm(os.path.join(directory, name))
+            if path in known:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            conn.execute(
+                "INSERT OR IGNORE INTO assets (path, size, created_at, owner) VALUES (?, ?, ?, NULL)",
+                (path, stat.st_size, stat.st_mtime),
+            )
+
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS, session_ttl=SESSION_TTL_SECONDS):
+    """
+    Forgets abandoned sessions and deletes assets, with their previews, that nothing has
+    referenced for the grace period and that are older than it. Returns the number of files removed.
+    """
+    now = time.time()
+    with _connect() as conn:
+        _adopt_untracked(conn)
+        expired = [row[0] for row in conn.execute(
+            "SELECT session_id FROM sessions WHERE last_seen < ?", (now - session_ttl,)
+        )]
+        conn.executemany("DELETE FROM refs WHERE session_id = ?", [(s,) for s in expired])
+        conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(s,) for s in expired])
+        # An asset's grace period starts again when its last reference goes away.
+        conn.execute(
+            "UPDATE assets SET unreferenced_since = NULL WHERE unreferenced_since IS NOT NULL "
+            "AND EXISTS (SELECT 1 FROM refs WHERE refs.path = assets.path)"
+        )
+        conn.execute(
+            "UPDATE assets SET unreferenced_since = ? WHERE unreferenced_since IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM refs WHERE refs.path = assets.path)",
+            (now,),
+        )
+        cutoff = now - grace_seconds
+        removed = [path for path, _ in _unreferenced(conn, "created_at < ? AND unreferenced_since < ?", (cutoff, cutoff))]
+        conn.executemany("DELETE FROM assets WHERE path = ?", [(p,) for p in removed])
+    _delete_files(removed)
+    if removed:
+        print(f"Asset GC removed {len(removed)} unreferenced files")
+    return len(removed)
+
+
+def _gc_loop(interval):
+    while True:
+        try:
+            collect_garbage()
+        except sqlite3.Error as e:
+            print(f"Asset GC failed: {e}")
+        time.sleep(interval)
+
+
+def start_gc_thread(interval=GC_INTERVAL_SECONDS):
+    """Starts the background garbage collector once per process."""
+    global _gc_thread
+    with _gc_lock:
+        if _gc_thread is None:
+            _gc_thread = threading.Thread(target=_gc_loop, args=(interval,), daemon=True, name="asset-gc")
+            _gc_thread.start()
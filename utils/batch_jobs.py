@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import time
+import uuid
+from utils import file_lock
+from utils.clients import client_fingerprint
+
+JOBS_DIR = ".cache"
+JOBS_FILE = os.path.join(JOBS_DIR, "batch_jobs.json")
+
+TERMINAL_STATES = ('JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED')
+QUEUED_STATES = ('JOB_STATE_QUEUED', 'JOB_STATE_PENDING', 'JOB_STATE_UNSPECIFIED')
+
+# Poll quickly right after submission (small jobs often finish within seconds),
+# then back off: gently while the job is running, further while it sits in the queue.
+POLL_INITIAL_SECONDS = 2
+POLL_FAST_WINDOW_SECONDS = 30
+POLL_BACKOFF_FACTOR = 1.5
+POLL_RUNNING_MAX_SECONDS = 10
+POLL_QUEUED_MAX_SECONDS = 60
+# Records are dropped this long after their job finished, or after it was submitted if it
+# never did (the Batch API expires jobs after 48 hours). A group goes with its last member.
+RECORD_TTL_SECONDS = 7 * 24 * 60 * 60
+
+_lock = threading.Lock()
+_pollers = {}
+_finished_events = {}
+
+
+def next_poll_interval(state, elapsed, previous):
+    if elapsed < POLL_FAST_WINDOW_SECONDS:
+        return POLL_INITIAL_SECONDS
+    cap = POLL_QUEUED_MAX_SECONDS if state in QUEUED_STATES else POLL_RUNNING_MAX_SECONDS
+    return min(previous * POLL_BACKOFF_FACTOR, cap)
+
+
+def _load():
+    try:
+        with open(JOBS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(jobs):
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    tmp_path = f"{JOBS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(jobs, f)
+    os.replace(tmp_path, JOBS_FILE)
+
+
+def _prune(jobs, now):
+    cutoff = now - RECORD_TTL_SECONDS
+    for name, record in list(jobs.items()):
+        if "members" not in record and (record.get("finished_at") or record.get("submitted_at") or now) < cutoff:
+            del jobs[name]
+    for name, record in list(jobs.items()):
+        if "members" in record and not any(member in jobs for member in record["members"]) and record.get("submitted_at", now) < cutoff:
+            del jobs[name]
+
+
+def _update(job_name, **fields):
+    with file_lock.locked(JOBS_FILE, _lock):
+        jobs = _load()
+        now = time.time()
+        _prune(jobs, now)
+        record = jobs.setdefault(job_name, {"name": job_name})
+        record.update(fields, updated_at=now)
+        _save(jobs)
+        return dict(record)
+
+
+def get_job(job_name):
+    """Returns the persisted record of a batch job or job group, or None if it is unknown."""
+    with _lock:
+        record = _load().get(job_name)
+    if record and "members" in record:
+        return _group_view(record)
+    return dict(record) if record else None
+
+
+def create_group(member_names, base_paths, metadata=None, slices=None):
+    """
+    Groups batch jobs that together produce one list of results, e.g. the shards of a book.
+    Each member's metadata["page_indices"] says where its results go in the merged list;
+    base_paths holds the results known up front ("" for the pages the members produce).
+    slices: per member, {"offset", "page_indices"} when the member is a job shared with
+    other books; its results from offset on belong to this group's page_indices.
+    """
+    group_name = f"groups/{uuid.uuid4().hex[:12]}"
+    _update(
+        group_name,
+        members=list(member_names),
+        slices=slices,
+        base_paths=list(base_paths),
+        metadata=metadata or {},
+        submitted_at=time.time(),
+    )
+    return group_name
+
+
+def _member_slice(group, position, member):
+    if group.get("slices"):
+        return group["slices"][position]
+    return {"offset": 0, "page_indices": member.get("metadata", {}).get("page_indices") or []}
+
+
+def _group_view(group):
+    members = [get_job(name) or {"name": name} for name in group["members"]]
+    slices = [_member_slice(group, position, member) for position, member in enumerate(members)]
+    view = dict(group)
+    view["num_requests"] = sum(len(member_slice["page_indices"]) for member_slice in slices)
+    unfinished = [member for member in members if not is_finished(member)]
+    if unfinished:
+        states = [member.get("state") for member in unfinished]
+        view["state"] = "JOB_STATE_RUNNING" if "JOB_STATE_RUNNING" in states else (states[0] or "JOB_STATE_PENDING")
+        poll_errors = [member["poll_error"] for member in unfinished if member.get("poll_error")]
+        if poll_errors:
+            view["poll_error"] = poll_errors[0]
+        return view
+
+    img_paths = list(group["base_paths"])
+    errors = [""] * len(img_paths)
+    for member, member_slice in zip(members, slices):
+        offset = member_slice["offset"]
+        for j, i in enumerate(member_slice["page_indices"]):
+            if offset + j < len(member["img_paths"]):
+                img_paths[i] = member["img_paths"][offset + j]
+                errors[i] = member["errors"][offset + j]
+            else:
+                errors[i] = f"no result, batch job ended as {member['state']}"
+    failed = [member["state"] for member in members if member["state"] != "JOB_STATE_SUCCEEDED"]
+    view.update(state=failed[0] if failed else "JOB_STATE_SUCCEEDED", img_paths=img_paths, errors=errors)
+    return view
+
+
+def is_finished(record):
+    return bool(record) and record.get("state") in TERMINAL_STATES and "img_paths" in record
+
+
+def _event(job_name):
+    with _lock:
+        return _finished_events.setdefault(job_name, threading.Event())
+
+
+def _collect(client, batch_job, metadata):
+    # Imported here because image_utils submits jobs through this module.
+    from utils.image_utils import collect_batch_results
+    return collect_batch_results(client, batch_job, metadata)
+
+
+def _poll(client, job_name):
+    record = get_job(job_name) or {}
+    started = record.get("submitted_at", time.time())
+    interval = POLL_INITIAL_SECONDS
+    try:
+        while True:
+            batch_job = client.batches.get(name=job_name)
+            state = batch_job.state.name
+            if state != record.get("state"):
+                print(f"Batch job {job_name}: {state}")
+                record = _update(job_name, state=state)
+            if state in TERMINAL_STATES:
+                break
+            interval = next_poll_interval(state, time.time() - started, interval)
+            time.sleep(interval)
+
+        img_path, error = _collect(client, batch_job, record.get("metadata"))
+        _update(job_name, img_paths=img_path, errors=error, finished_at=time.time())
+    except Exception as e:
+        # Leave the record unfinished so a later resume_jobs() can try again.
+        print(f"Polling batch job {job_name} failed: {e}")
+        _update(job_name, poll_error=str(e))
+    finally:
+        with _lock:
+            _pollers.pop(job_name, None)
+        _event(job_name).set()
+
+
+def _start_poller(client, job_name):
+    with _lock:
+        if job_name in _pollers:
+            return
+        thread = threading.Thread(target=_poll, args=(client, job_name), daemon=True, name=f"poll-{job_name}")
+        _pollers[job_name] = thread
+        _finished_events.setdefault(job_name, threading.Event()).clear()
+    thread.start()
+
+
+def submit_batch_job(client, model, src, display_name, num_requests, metadata=None):
+    """
+    Creates a batch job, persists its name and starts polling it in the background.
+    metadata: optional JSON-serialisable dict stored with the job, e.g. to restore the UI after a restart.
+    """
+    batch_job = client.batches.create(
+        model=model,
+        src=src,
+        config={
+            'display_name': display_name,
+        },
+    )
+    _update(
+        batch_job.name,
+        display_name=display_name,
+        state=batch_job.state.name if batch_job.state else None,
+        key=client_fingerprint(client),
+        num_requests=num_requests,
+        metadata=metadata or {},
+        submitted_at=time.time(),
+    )
+    _start_poller(client, batch_job.name)
+    return batch_job.name
+
+
+def unfinished_jobs(key):
+    """Names of the batch jobs submitted with the key fingerprint whose results are not collected yet."""
+    with _lock:
+        return [name for name, record in _load().items()
+                if record.get("key") == key and "members" not in record and "img_paths" not in record]
+
+
+def resume_jobs(client, job_names=None):
+    """
+    Restarts polling for jobs submitted with the current API key that were still
+    in flight when the process stopped. job_names limits it to these jobs and the
+    members of these groups. Returns the names of the resumed jobs.
+    """
+    pending = unfinished_jobs(client_fingerprint(client))
+    if job_names is not None:
+        wanted = set()
+        for name in job_names:
+            record = get_job(name)
+            wanted.update(record.get("members", [name]) if record else [])
+        pending = [name for name in pending if name in wanted]
+    for job_name in pending:
+        _start_poller(client, job_name)
+    return pending
+
+
+def wait_for_job(job_name, timeout=None):
+    """Blocks until the results of a job (or of every job in a group) are collected; returns the record."""
+    record = get_job(job_name)
+    if is_finished(record):
+        return record
+    deadline = None if timeout is None else time.time() + timeout
+    for name in (record or {}).get("members", [job_name]):
+        if not is_finished(get_job(name)):
+            _event(name).wait(None if deadline is None else max(0, deadline - time.time()))
+    return get_job(job_name)
@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Batch requests of every book in the process (UI sessions, CLI books, worker jobs) that
+# share an API key and model are held for a short window and submitted together, so many
+# small books become a few large batch jobs instead of one job each. A job goes out as
+# soon as it is full, or when the window of its oldest request has passed.
+COALESCE_WINDOW_SECONDS = 3.0
+MAX_CONCURRENT_SUBMITS = 4
+
+
+class BatchCoalescer:
+    """
+    Packs groups of requests into jobs of at most max_requests and submits each job with
+    submit_fn(client, requests), which returns the job's name. A group is never split
+    across jobs.
+    """
+    def __init__(self, submit_fn, max_requests, window=COALESCE_WINDOW_SECONDS, max_concurrent_submits=MAX_CONCURRENT_SUBMITS):
+        self.submit_fn = submit_fn
+        self.max_requests = max_requests
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent_submits, thread_name_prefix="batch-submit")
+
+    def submit(self, key, client, requests):
+        """
+        Queues a group of requests for the next job of key (e.g. API key and model). Returns a
+        Future of (job_name, offset): the group's results are the job's results from offset on.
+        """
+        future = Future()
+        ready = []
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch and batch["size"] + len(requests) > self.max_requests:
+                ready.append(self._pending.pop(key))
+                batch = None
+            if batch is None:
+                batch = self._pending[key] = {"client": client, "groups": [], "size": 0}
+                if self.window > 0:
+                    timer = threading.Timer(self.window, self._flush, args=(key, batch))
+                    timer.daemon = True
+                    timer.start()
+            batch["groups"].append((requests, future))
+            batch["size"] += len(requests)
+            if batch["size"] >= self.max_requests or self.window <= 0:
+                ready.append(self._pending.pop(key))
+        for batch in ready:
+            self._pool.submit(self._submit, batch)
+        return future
+
+    def _flush(self, key, batch):
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+            del self._pending[key]
+        self._pool.submit(self._submit, batch)
+
+    def _submit(self, batch):
+        requests = [request for group, _ in batch["groups"] for request in group]
+        try:
+            job_name = self.submit_fn(batch["client"], requests)
+        except Exception as e:
+            for _, future in batch["groups"]:
+                future.set_exception(e)
+            return
+        offset = 0
+        for group, future in batch["groups"]:
+            future.set_result((job_name, offset))
+            offset += len(group)
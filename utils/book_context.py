@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from utils import file_lock, upload_cache
+from utils.clients import client_fingerprint
+
+# The character references and descriptions are identical for every page of a book.
+# They are stored once as cached content (Gemini context caching) and every page
+# request then only carries its scene prompt. Where the API won't cache them (prefix
+# below the minimum size, model without caching support) pages send them inline as before.
+CONTEXT_TTL_SECONDS = 60 * 60
+# Batch jobs can sit in the queue for hours, so their context has to outlive the queue.
+BATCH_CONTEXT_TTL_SECONDS = 24 * 60 * 60
+EXPIRY_MARGIN_SECONDS = 5 * 60
+# Explicit caching has a minimum size; each image reference counts as at least 258 tokens.
+CONTEXT_MIN_TOKENS = 1024
+IMAGE_PART_TOKENS = 258
+# Creating a cache is a call of its own plus storage; for fewer requests resending is cheaper.
+CONTEXT_MIN_REQUESTS = 3
+# After the API refused to cache a prefix, don't ask again for this long.
+UNCACHEABLE_RETRY_SECONDS = 6 * 60 * 60
+CACHE_DIR = ".cache"
+CACHE_FILE = os.path.join(CACHE_DIR, "contexts.json")
+
+_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get("STORYBOOK_CONTEXT_CACHE", "1").lower() not in ("0", "false", "no", "off")
+
+
+def character_description(characters):
+    desc_text = "Character descriptions to maintain consistency:\n"
+    for char in characters or []:
+        if char.get("name") or char.get("traits"):
+            desc_text += f"Character: {char.get('name', '')}\nTraits: {char.get('traits', '')}\n\n"
+    return desc_text
+
+
+def page_prompt_text(prompt, characters):
+    """The full text of a page request that carries the character descriptions itself."""
+    if characters:
+        desc_text = character_description(characters)
+        if desc_text.strip():
+            prompt = f"Image Prompt :{prompt}"
+            prompt +=f" \n{desc_text}"
+    prompt+= "No wording in the image. "
+    return prompt
+
+
+class BookContext:
+    """
+    The shared prefix of a book's page requests. With cached_content set the prefix
+    lives on the API side and inline_files is empty; otherwise every request carries it.
+    """
+    def __init__(self, key, characters, char_files, reference_paths, cached_content=None):
+        self.key = key
+        self.characters = characters or []
+        self.char_files = char_files
+        self.reference_paths = reference_paths
+        self.cached_content = cached_content
+
+    @property
+    def inline_files(self):
+        return [] if self.cached_content else self.char_files
+
+    def prompt_text(self, prompt):
+        if self.cached_content:
+            return f"Image Prompt :{prompt} \nNo wording in the image. "
+        return page_prompt_text(prompt, self.characters)
+
+
+def _load():
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(entries):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, CACHE_FILE)
+
+
+def _put(key, entry, now):
+    with file_lock.locked(CACHE_FILE, _lock):
+        entries = {k: v for k, v in _load().items() if v.get("expires_at", 0) > now}
+        entries[key] = entry
+        _save(entries)
+
+
+def _context_key(client, model, description, char_files):
+    # Cached contents belong to the project of the API key and reference its uploads.
+    content = json.dumps([description, [f["uri"] for f in char_files]])
+    return f"{client_fingerprint(client)}:{model}:{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+
+
+def _estimated_tokens(description, char_files):
+    return len(description) // 4 + IMAGE_PART_TOKENS * len(char_files)
+
+
+def _create_cached_content(client, model, description, char_files, ttl_seconds):
+    from google.genai import types
+    parts = [types.Part(file_data=types.FileData(file_uri=f["uri"], mime_type=f["mime_type"])) for f in char_files]
+    parts.append(types.Part(text=description))
+    return client.caches.create(
+        model=model,
+        config=types.CreateCachedContentConfig(
+            contents=[types.Content(role="user", parts=parts)],
+            display_name="storybook-characters",
+            ttl=f"{ttl_seconds}s",
+        ),
+    )
+
+
+def get_book_context(client, model, characters, num_requests=1, ttl_seconds=CONTEXT_TTL_SECONDS):
+    """
+    Returns the BookContext for these characters. A live cached content of the same
+    prefix is reused; a new one is only created for at least CONTEXT_MIN_REQUESTS
+    requests and when the prefix is large enough to be cached.
+    """
+    reference_paths = [char.get("image") for char in characters or [] if char.get("image")]
+    # The references must outlive every request using them, e.g. a batch job queued for a day.
+    char_files = [upload_cache.get_uploaded_file(client, path, min_remaining=ttl_seconds) for path in reference_paths]
+    if not characters:
+        return BookContext(None, characters, char_files, reference_paths)
+    description = character_description(characters)
+    key = _context_key(client, model, description, char_files)
+    inline = BookContext(key, characters, char_files, reference_paths)
+    if not enabled():
+        return inline
+
+    now = time.time()
+    with _lock:
+        entry = _load().get(key)
+    if entry and entry.get("uncacheable") and entry.get("expires_at", 0) > now:
+        return inline
+    # A context picked up later still has to outlive the requests sent with it.
+    if entry and entry.get("name") and entry.get("expires_at", 0) > now + ttl_seconds / 2:
+        return BookContext(key, characters, char_files, reference_paths, entry["name"])
+    if num_requests < CONTEXT_MIN_REQUESTS or _estimated_tokens(description, char_files) < CONTEXT_MIN_TOKENS:
+        return inline
+
+    from google.genai import errors
+    try:
+        cached = _create_cached_content(client, model, description, char_files, ttl_seconds)
+    except errors.APIError as e:
+        print("Context caching unavailable, sending the characters with every page:", e)
+        if isinstance(e, errors.ClientError) and e.code != 429:
+            _put(key, {"uncacheable": True, "expires_at": now + UNCACHEABLE_RETRY_SECONDS}, now)
+        return inline
+    expires_at = now + ttl_seconds
+    if getattr(cached, "expire_time", None) is not None:
+        expires_at = min(expires_at, cached.expire_time.timestamp())
+    _put(key, {"name": cached.name, "expires_at": expires_at - EXPIRY_MARGIN_SECONDS}, now)
+    return BookContext(key, characters, char_files, reference_paths, cached.name)
+
+
+def is_rejected_context(e):
+    return e.code in (400, 403, 404) and "cache" in str(e).lower()
+
+
+def invalidate(context):
+    """Forgets a cached content, e.g. after the API reported it expired or missing."""
+    if not context.key:
+        return
+    with file_lock.locked(CACHE_FILE, _lock):
+        entries = _load()
+        if entries.pop(context.key, None) is not None:
+            _save(entries)
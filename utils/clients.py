@@ -0,0 +1,84 @@
+import contextvars
+import hashlib
+import os
+import threading
+from utils.disk_cache import make_key
+from utils.tracing import instrument_genai_client
+from utils.rate_limit import limit_genai_client, limit_runnable
+
+# One pooled HTTP client per API key, shared by every call and Streamlit rerun in the process.
+# The SDKs themselves are imported on first use: they take seconds to import and the app
+# should render before any of them is needed.
+HTTP_LIMITS = {"max_connections": 32, "max_keepalive_connections": 16, "keepalive_expiry": 60}
+
+# The key of the current Streamlit session (or CLI run). A context variable rather than
+# os.environ so that concurrent sessions with different keys never see each other's key.
+_current_api_key = contextvars.ContextVar("current_api_key", default=None)
+
+_lock = threading.Lock()
+_genai_clients = {}
+_client_fingerprints = {}
+_structured_llms = {}
+
+
+def base_url():
+    """Optional endpoint override, e.g. the local stand-in server in benchmarks/fake_gemini.py."""
+    return os.environ.get("GEMINI_BASE_URL") or None
+
+
+def set_current_api_key(api_key):
+    _current_api_key.set(api_key)
+
+
+def current_api_key():
+    return _current_api_key.get() or os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY") or ""
+
+
+def key_fingerprint(api_key=None):
+    if api_key is None:
+        api_key = current_api_key()
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def get_genai_client(api_key=None):
+    """Returns the shared genai.Client for the given (or current) API key."""
+    api_key = api_key or current_api_key()
+    fingerprint = key_fingerprint(api_key)
+    with _lock:
+        client = _genai_clients.get(fingerprint)
+        if client is None:
+            import httpx
+            from google import genai
+            from google.genai import types
+            client = genai.Client(
+                api_key=api_key or None,
+                http_options=types.HttpOptions(base_url=base_url(), client_args={"limits": httpx.Limits(**HTTP_LIMITS)}),
+            )
+            instrument_genai_client(client)
+            limit_genai_client(client, fingerprint)
+            _genai_clients[fingerprint] = client
+            _client_fingerprints[id(client)] = fingerprint
+        return client
+
+
+def client_fingerprint(client):
+    """Fingerprint of the key a client was created with; falls back to the current key for foreign clients."""
+    return _client_fingerprints.get(id(client)) or key_fingerprint()
+
+
+def get_structured_llm(model, schema, api_key=None):
+    """Returns a shared ChatGoogleGenerativeAI structured-output runnable per key, model and schema."""
+    api_key = api_key or current_api_key()
+    cache_key = (key_fingerprint(api_key), model, make_key(schema))
+    with _lock:
+        structured_llm = _structured_llms.get(cache_key)
+        if structured_llm is None:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            # Retries are left to utils.rate_limit, which all calls of the key share.
+            if base_url():
+                llm = ChatGoogleGenerativeAI(model=model, google_api_key=api_key or None, max_retries=1, base_url=base_url(), transport="rest")
+            else:
+                llm = ChatGoogleGenerativeAI(model=model, google_api_key=api_key or None, max_retries=1)
+            structured_llm = limit_runnable(llm.with_structured_output(schema=schema, method="json_schema"), cache_key[0], model)
+            _structured_llms[cache_key] = structured_llm
+        return structured_llm
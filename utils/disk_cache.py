@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+def make_key(*parts):
+    """Stable sha256 key for JSON-serialisable parts."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    A directory of cache entries, one file per key.
+    Entries are evicted least-recently-used first once the directory exceeds
+    max_bytes, and unconditionally once older than max_age seconds (if set).
+    A file's mtime records its last use, so the cache survives restarts and
+    can be shared by several processes without an index file.
+    """
+
+    def __init__(self, directory, max_bytes, max_age=None, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.suffix = suffix
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def get_path(self, key):
+        """Returns the path of a live entry (marking it as recently used), or None."""
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if self.max_age is not None and time.time() - mtime > self.max_age:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get_bytes(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def temp_path(self, key):
+        """A private path to write an entry to before commit()."""
+        os.makedirs(self.directory, exist_ok=True)
+        return f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def commit(self, key, tmp_path):
+        """Atomically publishes a file written to temp_path(key) as the entry for key."""
+        path = self._path(key)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def put_bytes(self, key, data):
+        tmp_path = self.temp_path(key)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self.commit(key, tmp_path)
+
+    def put_file(self, key, src_path):
+        tmp_path = self.temp_path(key)
+        shutil.copyfile(src_path, tmp_path)
+        return self.commit(key, tmp_path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        with self._lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return
+            now = time.time()
+            entries = []
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if self.max_age is not None and now - stat.st_mtime > self.max_age:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
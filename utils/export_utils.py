@@ -0,0 +1,59 @@
+import os
+import zipfile
+from utils import tracing
+from utils.disk_cache import DiskCache, make_key
+
+# Built archives are kept per distinct asset set, so reruns and repeated
+# downloads of an unchanged book never rebuild them.
+EXPORT_CACHE = DiskCache(os.path.join(".cache", "exports"), max_bytes=2 * 1024 * 1024 * 1024, suffix=".zip")
+# These formats are already compressed; deflating them again only costs CPU.
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
+
+
+def export_entries(img_paths, character_data, download_option="All"):
+    """Returns the (path, arcname) pairs of the assets selected for download."""
+    entries = []
+    if download_option in ["All", "Story Images"]:
+        for i, path in enumerate(img_paths):
+            if path and os.path.exists(path):
+                ext = os.path.splitext(path)[1]
+                entries.append((path, f"story_images/{i+1}{ext}"))
+
+    if download_option in ["All", "Character Images"]:
+        for i, char in enumerate(character_data):
+            path = char.get("image")
+            if path and os.path.exists(path):
+                ext = os.path.splitext(path)[1]
+                entries.append((path, f"characters/{i+1}{ext}"))
+    return entries
+
+
+def export_key(entries):
+    """Identifies an archive by its entries and the mtime/size of every file."""
+    parts = []
+    for path, arcname in entries:
+        stat = os.stat(path)
+        parts.append((arcname, os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+    return make_key("export", parts)
+
+
+def cached_export(entries):
+    """Path of an already built archive for these entries, or None."""
+    return EXPORT_CACHE.get_path(export_key(entries))
+
+
+def build_export_zip(entries):
+    """Builds (or reuses) the ZIP archive for the entries on disk and returns its path."""
+    key = export_key(entries)
+    path = EXPORT_CACHE.get_path(key)
+    if path is not None:
+        return path
+    tmp_path = EXPORT_CACHE.temp_path(key)
+    with tracing.span("export.zip", files=len(entries)) as span:
+        with zipfile.ZipFile(tmp_path, "w") as zf:
+            for src, arcname in entries:
+                ext = os.path.splitext(src)[1].lower()
+                compression = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                zf.write(src, arcname=arcname, compress_type=compression)
+        span.set(bytes=os.path.getsize(tmp_path))
+    return EXPORT_CACHE.commit(key, tmp_path)
@@ -0,0 +1,29 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process per directory is supported there.
+    fcntl = None
+
+# The JSON stores under .cache/ and projects/ are shared by the app, the workers and the
+# CLI. Their writes replace the whole file, so every read-modify-write holds the store's
+# thread lock (for this process) and an advisory lock on "<file>.lock" (for the others).
+
+
+@contextlib.contextmanager
+def locked(path, thread_lock):
+    """Holds thread_lock and an exclusive lock on path + ".lock" while the block runs."""
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
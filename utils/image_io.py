@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from utils import tracing
+
+# Generated images are written as the bytes the API sent, named after their real format.
+# Anything that has to decode or re-encode pixels (previews, transcoding uploads) runs in
+# a small process pool so it neither holds the GIL nor blocks the thread that asked for it.
+EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+ENCODE_MAX_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+_lock = threading.Lock()
+_pool = None
+
+
+def sniff_mime_type(head):
+    """Image mime type from the first bytes of a file, or None if it isn't a format the app stores as is."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def with_extension(path, mime_type):
+    """path with the extension of mime_type; unchanged for an unknown type."""
+    extension = EXTENSIONS.get(mime_type)
+    return os.path.splitext(path)[0] + extension if extension else path
+
+
+def file_extension(path):
+    """The extension matching the content of an image file, or "" if unknown."""
+    try:
+        with open(path, "rb") as f:
+            return EXTENSIONS.get(sniff_mime_type(f.read(16)), "")
+    except OSError:
+        return ""
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            # spawn: forking a process that runs Streamlit's and the SDKs' threads is unsafe.
+            # Workers trace their spans but leave the metrics file to this process.
+            _pool = ProcessPoolExecutor(max_workers=ENCODE_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=tracing.set_metrics_file, initargs=(None,))
+        return _pool
+
+
+def submit(fn, *args):
+    """
+    Runs fn(*args) in the encoding process pool and returns a Future. fn must be a
+    module-level function. Falls back to the calling thread if no pool can be started.
+    """
+    global _pool
+    try:
+        return _executor().submit(fn, *args)
+    except (OSError, RuntimeError) as e:
+        print(f"Encoding pool unavailable, encoding in-process: {e}")
+        with _lock:
+            _pool = None
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def run(fn, *args):
+    """submit(fn, *args) and wait for the result."""
+    return submit(fn, *args).result()
+
+
+def _transcode_to_png(src_path, dest_path):
+    from PIL import Image
+    with Image.open(src_path) as image:
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, format="PNG")
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+def store_image_file(data, path):
+    """
+    Stores uploaded image bytes at path (its extension is adjusted to the content).
+    Formats the API accepts are written as they are; anything else is converted to PNG
+    in the encoding pool. Returns the path written.
+    """
+    mime_type = sniff_mime_type(data[:16])
+    if mime_type in ("image/png", "image/jpeg", "image/webp"):
+        path = with_extension(path, mime_type)
+        write_atomic(path, data)
+        return path
+    src_path = f"{path}.{os.getpid()}.{threading.get_ident()}.src"
+    write_atomic(src_path, data)
+    try:
+        return run(_transcode_to_png, src_path, with_extension(path, "image/png"))
+    finally:
+        os.remove(src_path)
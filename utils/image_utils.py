@@ -1,15 +1,41 @@
-from google import genai
 from google.genai import types
+from google.genai import errors
 import uuid
 import os
-import time
-from PIL import Image
+import json
+import math
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.genai.types import (
     HarmCategory,
     HarmBlockThreshold,
     SafetySetting,
     FinishReason
 )
+from utils import upload_cache, batch_jobs, batch_scheduler, asset_store, tracing, book_context, image_io
+from utils.clients import client_fingerprint, get_genai_client
+from utils.disk_cache import DiskCache, make_key
+from utils.preview_utils import schedule_preview
+
+IMAGE_MODEL = "gemini-2.5-flash-image"
+# Interactive mode sends one generate_content call per page through a bounded pool.
+INTERACTIVE_MAX_WORKERS = 5
+# Rough planning figures for choose_execution_mode: a single image call takes
+# ~15 s, while a batch job spends minutes in the queue before it even runs.
+INTERACTIVE_SECONDS_PER_IMAGE = 15
+BATCH_EXPECTED_SECONDS = 10 * 60
+INTERACTIVE_MAX_PAGES = 10
+# Batch jobs are submitted as JSONL files of at most BATCH_SHARD_SIZE pages; larger
+# books are split across several jobs that run concurrently and merge back in page order,
+# smaller ones share a job with the other books submitted at about the same time.
+BATCH_SHARD_SIZE = 25
+BATCH_MAX_CONCURRENT_SUBMITS = 4
+BATCH_REQUESTS_DIR = os.path.join(".cache", "batch_requests")
+# Opt-in cache of generated images, keyed by everything that was sent to the model.
+IMAGE_CACHE = DiskCache(os.path.join(".cache", "images"), max_bytes=500 * 1024 * 1024)
+# Follow-up passes that re-run only the pages that failed or were blocked. Up to
+# INTERACTIVE_MAX_PAGES failures are retried concurrently, more go out as one small batch.
+FAILED_PAGE_RETRIES = 2
 safety_settings = [
     SafetySetting(
         category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
@@ -29,104 +55,460 @@ safety_settings = [
     ),
 ]
 
-def generate_image_nanobanana(image_prompts,characters=None,ratio="1.1"):
+def _save_part_image(part, save_path):
     """
-    image_prompts: list of text prompts for each page
-    ratio: image aspect ratio
-    characters: optional list of dicts with keys: 'name', 'traits', 'image' (local file or uploaded)
+    Writes the bytes of an image part as they came, under save_path with the extension of
+    their real format, and starts rendering the UI preview in the background. Returns the path.
     """
-    output_dir = "images"
-    os.makedirs(output_dir, exist_ok=True)
-    CHAR_DIR = "characters"
-    os.makedirs(CHAR_DIR, exist_ok=True)
+    save_path = image_io.with_extension(save_path, part.inline_data.mime_type)
+    with tracing.span("image.save", path=save_path, bytes=len(part.inline_data.data)):
+        image_io.write_atomic(save_path, part.inline_data.data)
+    schedule_preview(save_path)
+    asset_store.register(save_path)
+    return save_path
 
-    client = genai.Client()
-    inline_requests = []
-    characters_uriandmime=[]
-    error = []
-    for char in characters:
-        char_image = char.get("image")
-        char_file = client.files.upload(file=char_image)
-        characters_uriandmime.append({"uri":char_file.uri,"mime_type":char_file.mime_type})
-
-    for prompt in image_prompts:
-            contents_list = []
-
-            if characters:
-                desc_text = "Character descriptions to maintain consistency:\n"
-                
-                for i,char in enumerate(characters):
-                    char_image = char.get("image")
-                    
-                    if char.get("name") or char.get("traits"):
-                        desc_text += f"Character: {char.get('name', '')}\nTraits: {char.get('traits', '')}\n\n"     
-
-                    contents_list.append({
-                            "file_data": {"file_uri": characters_uriandmime[i]["uri"], "mime_type": characters_uriandmime[i]["mime_type"]}
-                        })
-                if desc_text.strip():
-                    prompt = f"Image Prompt :{prompt}"
-                    prompt +=f" \n{desc_text}"
-            prompt+= "No wording in the image. "       
-            contents_list.append({"text": prompt})
-            inline_requests.append({
-                "contents": [
-                    {
-                        "parts": contents_list,
-                        "role": "user"
-                    }
-                ],
-                "config": types.GenerateContentConfig(
-                    image_config=types.ImageConfig(aspect_ratio=ratio),
-                    safety_settings= safety_settings
-                )
-            })
-    inline_batch_job = client.batches.create(
-    model="models/gemini-2.5-flash-image",
-    src=inline_requests,
-    config={
-        'display_name': "inlined-requests-job-1",
-    },
+def _is_rejected_upload(e):
+    return e.code in (400, 403, 404) and "file" in str(e).lower()
+
+def _page_request_parts(context, prompt):
+    """The parts of one page request on top of a BookContext: inline references (if any) and the prompt."""
+    parts = [
+        types.Part(file_data=types.FileData(file_uri=f["uri"], mime_type=f["mime_type"]))
+        for f in context.inline_files
+    ]
+    parts.append(types.Part(text=context.prompt_text(prompt)))
+    return parts
+
+def _generate_with_context(client, characters, ratio, build_parts, context=None, extra_uploads=()):
+    """
+    Calls generate_content with build_parts(context) on top of the book's shared context
+    (see utils.book_context). If the API rejects the cached context or a cached upload,
+    it is dropped and the call is retried once with the characters sent inline.
+    """
+    context = context or book_context.get_book_context(client, IMAGE_MODEL, characters)
+
+    def call(context):
+        return client.models.generate_content(
+            model=IMAGE_MODEL,
+            contents=build_parts(context),
+            config=types.GenerateContentConfig(
+                image_config=types.ImageConfig(aspect_ratio=ratio),
+                safety_settings= safety_settings,
+                cached_content=context.cached_content,
+            )
+        )
+
+    try:
+        return call(context)
+    except errors.ClientError as e:
+        uploaded_paths = list(extra_uploads) + context.reference_paths
+        rejected_context = bool(context.cached_content) and book_context.is_rejected_context(e)
+        if not rejected_context and not (uploaded_paths and _is_rejected_upload(e)):
+            raise
+        print("Cached context or upload rejected, resending:", e)
+        book_context.invalidate(context)
+        if not rejected_context:
+            upload_cache.invalidate(client, uploaded_paths)
+        return call(book_context.get_book_context(client, IMAGE_MODEL, characters))
+
+def image_cache_key(prompt_text, reference_paths, ratio, model=IMAGE_MODEL, reference_digests=None):
+    """
+    Key of a generated image: final prompt text, reference image contents, aspect ratio and model.
+    reference_digests: the references' sha256 digests, if the caller already hashed them.
+    """
+    if reference_digests is None:
+        reference_digests = [upload_cache.file_sha256(path) for path in reference_paths if path]
+    return make_key("image", model, ratio, prompt_text, reference_digests)
+
+def _page_cache_keys(image_prompts, characters, ratio):
+    reference_paths = [char.get("image") for char in characters or []]
+    # The references are the same for every page; hashing them per page re-reads them per page.
+    digests = [upload_cache.file_sha256(path) for path in reference_paths if path]
+    return [image_cache_key(book_context.page_prompt_text(prompt, characters), reference_paths, ratio, reference_digests=digests)
+            for prompt in image_prompts]
+
+def _cached_image(key, filename):
+    """Copies a cached image into images/ so later cache eviction never breaks a page. Returns the path or None."""
+    cached_path = IMAGE_CACHE.get_path(key)
+    if cached_path is None:
+        return None
+    os.makedirs("images", exist_ok=True)
+    save_path = os.path.join("images", filename)
+    extension = image_io.file_extension(cached_path)
+    if extension:
+        save_path = os.path.splitext(save_path)[0] + extension
+    with tracing.span("image.cache_copy", path=save_path, bytes=os.path.getsize(cached_path)):
+        tmp_path = f"{save_path}.{os.getpid()}.tmp"
+        shutil.copyfile(cached_path, tmp_path)
+        os.replace(tmp_path, save_path)
+    schedule_preview(save_path)
+    asset_store.register(save_path)
+    return save_path
+
+def _remember_image(key, path):
+    if key and path:
+        IMAGE_CACHE.put_file(key, path)
+
+def cached_page_images(image_prompts,characters=None,ratio="1:1",keys=None,page_indices=None):
+    """
+    Returns, per page, the path of a cached illustration or "" when the page has to be generated.
+    keys: the pages' cache keys, if the caller already computed them (see _page_cache_keys).
+    page_indices: only these pages are looked up (and copied into images/); the others get "".
+    """
+    page_indices = range(len(image_prompts)) if page_indices is None else page_indices
+    if keys is None:
+        page_keys = _page_cache_keys([image_prompts[i] for i in page_indices], characters, ratio)
+    else:
+        page_keys = [keys[i] for i in page_indices]
+    paths = [""] * len(image_prompts)
+    for i, key in zip(page_indices, page_keys):
+        paths[i] = _cached_image(key, f"output_{i+1} {uuid.uuid4().hex}.png") or ""
+    return paths
+
+def _batch_request(context, prompt, ratio):
+    """One request of a file-sourced batch: a GenerateContentRequest in REST JSON form."""
+    parts = [{"fileData": {"fileUri": f["uri"], "mimeType": f["mime_type"]}} for f in context.inline_files]
+    parts.append({"text": context.prompt_text(prompt)})
+    request = {
+        "contents": [{"role": "user", "parts": parts}],
+        "generationConfig": {"imageConfig": {"aspectRatio": ratio}},
+        "safetySettings": [
+            {"category": setting.category.value, "threshold": setting.threshold.value}
+            for setting in safety_settings
+        ],
+    }
+    if context.cached_content:
+        request["cachedContent"] = context.cached_content
+    return request
+
+def _submit_batch_requests(client, requests):
+    """
+    Submits page requests, possibly of several books, as one batch job. Each request is
+    {"request", "page_index", "cache_key"}; lines are keyed by their position in the job.
+    """
+    with tracing.span("batch.submit_shard", pages=len(requests)):
+        os.makedirs(BATCH_REQUESTS_DIR, exist_ok=True)
+        requests_path = os.path.join(BATCH_REQUESTS_DIR, f"pages {uuid.uuid4().hex}.jsonl")
+        request_keys = [f"request-{j}" for j in range(len(requests))]
+        with open(requests_path, "w", encoding="utf-8") as f:
+            for key, request in zip(request_keys, requests):
+                f.write(json.dumps({"key": key, "request": request["request"]}) + "\n")
+        try:
+            requests_file = client.files.upload(
+                file=requests_path,
+                config=types.UploadFileConfig(display_name=os.path.basename(requests_path), mime_type="jsonl"),
+            )
+        finally:
+            os.remove(requests_path)
+        return batch_jobs.submit_batch_job(
+            client,
+            model=f"models/{IMAGE_MODEL}",
+            src=requests_file.name,
+            display_name=f"storybook-pages-{len(requests)}",
+            num_requests=len(requests),
+            metadata={
+                "page_indices": [request["page_index"] for request in requests],
+                "request_keys": request_keys,
+                "cache_keys": [request["cache_key"] for request in requests],
+            },
+        )
+
+_batch_scheduler = batch_scheduler.BatchCoalescer(_submit_batch_requests, BATCH_SHARD_SIZE, max_concurrent_submits=BATCH_MAX_CONCURRENT_SUBMITS)
+
+def submit_image_job(image_prompts,characters=None,ratio="1:1",metadata=None,use_cache=False,force_new=False,base_paths=None):
+    """
+    Submits the page illustrations as batch jobs without waiting for them to run.
+    Pages are split into shards of BATCH_SHARD_SIZE and handed to the batch scheduler,
+    which packs shards of books submitted within a few seconds of each other into shared
+    jobs. The book's jobs are tracked as one group in utils.batch_jobs and polled in the
+    background. Returns (group name, base_paths with the cached pages filled in).
+    With use_cache, pages found in the image cache are not submitted (unless force_new); when
+    every page is cached the group name is None and base_paths is the finished book.
+    base_paths: images that already exist ("" for missing pages); only the missing pages
+    are submitted, e.g. to retry the failed pages of a finished job.
+    """
+    client = get_genai_client()
+    cache_keys = None
+    base_paths = list(base_paths) if base_paths else [""] * len(image_prompts)
+    if use_cache:
+        cache_keys = _page_cache_keys(image_prompts, characters, ratio)
+        if not force_new:
+            # Pages the caller already has are not looked up, so no copies of them are left behind.
+            cached = cached_page_images(image_prompts, characters, ratio, keys=cache_keys, page_indices=failed_pages(base_paths, len(image_prompts)))
+            base_paths = [path or cached_path for path, cached_path in zip(base_paths, cached)]
+    page_indices = [i for i, path in enumerate(base_paths) if not path]
+    if not page_indices:
+        return None, base_paths
+
+    # Every page shares one cached character context, kept alive long enough for the queue.
+    context = book_context.get_book_context(client, IMAGE_MODEL, characters, num_requests=len(page_indices),
+                                            ttl_seconds=book_context.BATCH_CONTEXT_TTL_SECONDS)
+    shards = [page_indices[i:i + BATCH_SHARD_SIZE] for i in range(0, len(page_indices), BATCH_SHARD_SIZE)]
+    futures = [
+        _batch_scheduler.submit((client_fingerprint(client), IMAGE_MODEL), client, [
+            {"request": _batch_request(context, image_prompts[i], ratio), "page_index": i,
+             "cache_key": cache_keys[i] if cache_keys else None}
+            for i in shard
+        ])
+        for shard in shards
+    ]
+    placements = [future.result() for future in futures]
+    job_names = [job_name for job_name, _ in placements]
+    group_name = batch_jobs.create_group(
+        job_names, base_paths, metadata=metadata,
+        slices=[{"offset": offset, "page_indices": shard} for (_, offset), shard in zip(placements, shards)],
     )
-    job_name = inline_batch_job.name
-    print(f"Polling status for job: {job_name}")
-    while True:
-        batch_job_inline = client.batches.get(name=job_name)
-        if batch_job_inline.state.name in ('JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'):
-            break
-        print(f"Job not finished. Current state: {batch_job_inline.state.name}. Waiting 30 seconds...")
-        time.sleep(30)
+    print(f"Polling status for jobs: {', '.join(job_names)}")
+    return group_name, base_paths
+
+def resume_image_jobs(job_names=None):
+    """
+    Resumes polling of batch jobs left in flight by a previous run for the current API key,
+    or only of job_names (jobs or groups).
+    """
+    return batch_jobs.resume_jobs(get_genai_client(), job_names)
+
+def collect_batch_results(client, batch_job_inline, metadata=None):
+    """
+    Saves the images of a finished batch job. Returns (img_path, error) lists in request order.
+    If the job was submitted with use_cache, results are stored in the image cache.
+    """
+    metadata = metadata or {}
+    with tracing.span("batch.collect", job=batch_job_inline.name, state=batch_job_inline.state.name) as span:
+        img_path, error = _save_batch_responses(client, batch_job_inline, metadata.get("page_indices"), metadata.get("request_keys"))
+        for key, path in zip(metadata.get("cache_keys", []), img_path):
+            _remember_image(key, path)
+        span.set(pages=len(img_path), failed=sum(1 for path in img_path if not path))
+    return img_path, error
+
+def _download_batch_responses(client, file_name, request_keys):
+    """Reads a batch results file and returns InlinedResponses ordered like the submitted requests."""
+    data = client.files.download(file=file_name)
+    by_key = {}
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        if result.get("response") is not None:
+            by_key[result.get("key")] = types.InlinedResponse(
+                response=types.GenerateContentResponse._from_response(response=result["response"], kwargs={})
+            )
+        else:
+            by_key[result.get("key")] = types.InlinedResponse(
+                error=types.JobError(message=str(result.get("error", "no response for this page")))
+            )
+    return [by_key.get(key, types.InlinedResponse()) for key in request_keys]
+
+def _save_batch_responses(client, batch_job_inline, page_indices=None, request_keys=None):
+    """
+    Saves the images of a finished batch job. Returns (img_path, error) lists with exactly
+    one entry per request, so a blocked or empty response never shifts later pages.
+    """
+    output_dir = "images"
+    os.makedirs(output_dir, exist_ok=True)
     print(f"Job finished with state: {batch_job_inline.state.name}")
-    if batch_job_inline.state.name == 'JOB_STATE_SUCCEEDED':
-        img_path=[]
-    for i, inline_response in enumerate(batch_job_inline.dest.inlined_responses, start=1):
-        print(f"\n--- Response {i} ---")
-        unique_filename = f"output_{i} {uuid.uuid4().hex}.png"
-        output_path = os.path.join("images", unique_filename)
-        if inline_response.response:
-            if getattr(inline_response.response, "prompt_feedback", None) is not None:
-                if inline_response.response.prompt_feedback.block_reason is not None:
-                    print("Response blocked:", inline_response.response.prompt_feedback.block_reason)
-                    img_path.append("")
-                    error.append(inline_response.response.prompt_feedback.block_reason)
-            elif (inline_response.response.candidates[0].finish_reason==FinishReason.STOP):
-                for part in inline_response.response.candidates[0].content.parts:
-                    if part.text is not None:
-                        print(part.text)
-                    elif part.inline_data is not None:
-                        image = part.as_image()
-                        image.save(output_path)
-                        img_path.append(output_path)
-                error.append("")
-            else:
-                img_path.append("")
-                error.append(inline_response.response.candidates[0].finish_reason)
+    if batch_job_inline.dest and batch_job_inline.dest.file_name:
+        # Jobs submitted before requests were keyed by position used the page index.
+        request_keys = request_keys or [f"page-{i}" for i in page_indices or []]
+        responses = _download_batch_responses(client, batch_job_inline.dest.file_name, request_keys)
+    elif batch_job_inline.dest:
+        responses = batch_job_inline.dest.inlined_responses or []
+    else:
+        responses = []
+    num_requests = len(page_indices) if page_indices is not None else len(responses)
+    img_path = [""] * num_requests
+    error = [f"no result, batch job ended as {batch_job_inline.state.name}"] * num_requests
+    for j, inline_response in enumerate(responses[:num_requests]):
+        page = page_indices[j] + 1 if page_indices is not None else j + 1
+        if inline_response.response is None:
+            error[j] = inline_response.error.message if inline_response.error else "no response for this page"
+            continue
+        save_path, error[j] = _save_first_image(inline_response.response, output_dir, f"output_{page} {uuid.uuid4().hex}.png")
+        img_path[j] = save_path or ""
     return img_path,error
 
+def choose_execution_mode(num_pages, latency_budget=None):
+    """
+    Picks "batch" or "interactive" for a book.
+    Batch is half the price but queues for minutes, so it is used whenever the latency
+    budget (seconds) allows it. Otherwise the book goes interactive, unless it is so long
+    that batch would still finish first. Without a budget short books go interactive.
+    """
+    if latency_budget is None:
+        return "interactive" if num_pages <= INTERACTIVE_MAX_PAGES else "batch"
+    if BATCH_EXPECTED_SECONDS <= latency_budget:
+        return "batch"
+    # Neither mode may meet the budget; then the faster one misses it by less.
+    return "interactive" if estimate_interactive_seconds(num_pages) < BATCH_EXPECTED_SECONDS else "batch"
+
+def estimate_interactive_seconds(num_pages, max_workers=INTERACTIVE_MAX_WORKERS):
+    """Rough wall time of num_pages interactive image calls, max_workers at a time."""
+    return math.ceil(num_pages / max_workers) * INTERACTIVE_SECONDS_PER_IMAGE
+
+def _save_first_image(response, output_dir, filename):
+    """Saves the first image of a generate_content response. Returns (save_path, error)."""
+    if getattr(response, "prompt_feedback", None) is not None:
+        if response.prompt_feedback.block_reason is not None:
+            print("Response blocked:", response.prompt_feedback.block_reason)
+            return None, response.prompt_feedback.block_reason
+    if not response.candidates:
+        return None, "the model did not return any picture."
+    candidate = response.candidates[0]
+    if candidate.finish_reason is not None and candidate.finish_reason != FinishReason.STOP:
+        return None, candidate.finish_reason
+    for part in (candidate.content.parts if candidate.content else None) or []:
+        if part.inline_data is not None:
+            return _save_part_image(part, os.path.join(output_dir, filename)), ""
+    return None, "the model did not return any picture."
+
+def _generate_page_interactive(client, page_index, prompt, characters, ratio, cache_key=None, context=None):
+    with tracing.span("image.page", page=page_index + 1) as span:
+        save_path, error = _generate_page(client, page_index, prompt, characters, ratio, cache_key, context)
+        span.set(ok=bool(save_path), error=str(error) if error else None)
+    return save_path, error
+
+def _generate_page(client, page_index, prompt, characters, ratio, cache_key, context=None):
+    try:
+        response = _generate_with_context(client, characters, ratio, lambda context: _page_request_parts(context, prompt), context)
+    except errors.APIError as e:
+        print(f"Page {page_index + 1} failed:", e)
+        return "", str(e)
+    save_path, error = _save_first_image(response, "images", f"output_{page_index + 1} {uuid.uuid4().hex}.png")
+    _remember_image(cache_key, save_path)
+    return save_path or "", error
+
+def generate_page_nanobanana(page_index, prompt, characters=None, ratio="1:1", use_cache=False, force_new=False, context=None):
+    """
+    Illustrates a single book page with a direct generate_content call. Returns (img_path, error).
+    With use_cache an unchanged page is served from the image cache unless force_new is set.
+    context: the book's BookContext, so the pages of one book share its cached characters.
+    """
+    os.makedirs("images", exist_ok=True)
+    cache_key = _page_cache_keys([prompt], characters, ratio)[0] if use_cache else None
+    if cache_key and not force_new:
+        cached_path = _cached_image(cache_key, f"output_{page_index+1} {uuid.uuid4().hex}.png")
+        if cached_path:
+            return cached_path, ""
+    return _generate_page_interactive(get_genai_client(), page_index, prompt, characters, ratio, cache_key, context)
+
+def failed_pages(img_paths, num_pages=None):
+    """Indices of the pages without an image."""
+    num_pages = len(img_paths) if num_pages is None else num_pages
+    return [i for i in range(num_pages) if i >= len(img_paths) or not img_paths[i]]
+
+def iter_pages_nanobanana(image_prompts, page_indices, characters=None, ratio="1:1", max_workers=INTERACTIVE_MAX_WORKERS, use_cache=False):
+    """
+    Generates only the given pages concurrently with direct generate_content calls, yielding
+    (page_index, img_path, error) in completion order. Always asks the model (no cache
+    lookup, e.g. for retries); with use_cache the new images are cached.
+    """
+    os.makedirs("images", exist_ok=True)
+    keys = _page_cache_keys(image_prompts, characters, ratio) if use_cache else [None] * len(image_prompts)
+    client = get_genai_client()
+    # Upload the references and cache the shared character context once up front.
+    context = book_context.get_book_context(client, IMAGE_MODEL, characters, num_requests=len(page_indices))
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            pool.submit(_generate_page_interactive, client, i, image_prompts[i], characters, ratio, keys[i], context): i
+            for i in page_indices
+        }
+        for future in as_completed(futures):
+            img_path, error = future.result()
+            yield futures[future], img_path, error
+    finally:
+        # If the consumer stops early (e.g. a Streamlit rerun), drop the pages not started yet.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def retry_failed_pages(image_prompts, img_paths, errors, characters=None, ratio="1:1", retries=FAILED_PAGE_RETRIES, use_cache=False, allow_batch=True):
+    """
+    Runs up to `retries` follow-up passes over the pages that have no image, leaving the
+    rest of the book untouched. Returns the updated (img_path, error) lists.
+    allow_batch=False keeps every pass interactive, for callers that must not wait on a batch job.
+    """
+    img_paths = list(img_paths) + [""] * (len(image_prompts) - len(img_paths))
+    errors = list(errors) + [""] * (len(image_prompts) - len(errors))
+    for attempt in range(1, retries + 1):
+        # A page without a prompt (its prompt group failed) waits for one to be written by hand.
+        failed = [i for i in failed_pages(img_paths, len(image_prompts)) if image_prompts[i]]
+        if not failed:
+            break
+        print(f"Retrying {len(failed)} failed pages (attempt {attempt}/{retries})")
+        if len(failed) <= INTERACTIVE_MAX_PAGES or not allow_batch:
+            for i, path, error in iter_pages_nanobanana(image_prompts, failed, characters, ratio, use_cache=use_cache):
+                img_paths[i] = path
+                errors[i] = error
+            continue
+        job_name, _ = submit_image_job(image_prompts, characters=characters, ratio=ratio, use_cache=use_cache, force_new=True, base_paths=img_paths)
+        record = batch_jobs.wait_for_job(job_name)
+        if not batch_jobs.is_finished(record):
+            print(f"Retry job {job_name} did not finish: {record.get('poll_error', '')}")
+            break
+        for i in failed:
+            img_paths[i] = record["img_paths"][i]
+            errors[i] = record["errors"][i]
+    return img_paths, errors
+
+def iter_images_nanobanana(image_prompts,characters=None,ratio="1:1",max_workers=INTERACTIVE_MAX_WORKERS,use_cache=False,force_new=False):
+    """
+    Generates pages concurrently like generate_images_interactive, but yields
+    (page_index, img_path, error) as soon as each page finishes, in completion order.
+    With use_cache, cached pages are yielded first (unless force_new) and new images are cached.
+    """
+    os.makedirs("images", exist_ok=True)
+    keys = _page_cache_keys(image_prompts, characters, ratio) if use_cache else [None] * len(image_prompts)
+    pending = []
+    for i, key in enumerate(keys):
+        cached_path = _cached_image(key, f"output_{i+1} {uuid.uuid4().hex}.png") if key and not force_new else None
+        if cached_path:
+            yield i, cached_path, ""
+        else:
+            pending.append(i)
+    if pending:
+        yield from iter_pages_nanobanana(image_prompts, pending, characters, ratio, max_workers=max_workers, use_cache=use_cache)
+
+def generate_images_interactive(image_prompts,characters=None,ratio="1:1",max_workers=INTERACTIVE_MAX_WORKERS,use_cache=False,force_new=False):
+    """
+    Generates every page with a direct generate_content call, running up to
+    max_workers requests concurrently. Returns (img_path, error) lists in page order,
+    the same shape as generate_image_nanobanana.
+    """
+    img_path = [""] * len(image_prompts)
+    error = [""] * len(image_prompts)
+    for i, path, err in iter_images_nanobanana(image_prompts, characters=characters, ratio=ratio, max_workers=max_workers, use_cache=use_cache, force_new=force_new):
+        img_path[i] = path
+        error[i] = err
+    return img_path, error
+
+def generate_image_nanobanana(image_prompts,characters=None,ratio="1.1",mode="batch",latency_budget=None,use_cache=False,force_new=False,retries=FAILED_PAGE_RETRIES):
+    """
+    image_prompts: list of text prompts for each page
+    ratio: image aspect ratio
+    characters: optional list of dicts with keys: 'name', 'traits', 'image' (local file or uploaded)
+    mode: "batch", "interactive" or "auto" (see choose_execution_mode)
+    latency_budget: seconds the caller is willing to wait, used by mode="auto"
+    use_cache: serve unchanged pages from the image cache; force_new skips the lookup but still caches the results
+    retries: follow-up passes over failed or blocked pages only (see retry_failed_pages)
+    """
+    if mode == "auto":
+        mode = choose_execution_mode(len(image_prompts), latency_budget)
+    if mode == "interactive":
+        img_paths, errors = generate_images_interactive(image_prompts, characters=characters, ratio=ratio, use_cache=use_cache, force_new=force_new)
+    else:
+        job_name, img_paths = submit_image_job(image_prompts, characters=characters, ratio=ratio, use_cache=use_cache, force_new=force_new)
+        if job_name is None:
+            return img_paths, [""] * len(image_prompts)
+        record = batch_jobs.wait_for_job(job_name)
+        if not batch_jobs.is_finished(record):
+            raise RuntimeError(f"Batch job {job_name} did not finish: {record.get('poll_error', '')}")
+        img_paths, errors = record["img_paths"], record["errors"]
+    return retry_failed_pages(image_prompts, img_paths, errors, characters=characters, ratio=ratio, retries=retries, use_cache=use_cache)
+
 def generate_character_nanobanana(characters,genre,tone,art_style,i,ratio):
     CHAR_DIR = "characters"
     os.makedirs(CHAR_DIR, exist_ok=True)
-    client = genai.Client()
+    client = get_genai_client()
     prompt = (
         "Generate A character based on the details below, ensure the quality of the character. (Dont include any words)" \
         "Do not include additional character in the picture unless stated."
@@ -157,54 +539,30 @@ def generate_character_nanobanana(characters,genre,tone,art_style,i,ratio):
             if part.text is not None:
                 print(part.text)
             elif part.inline_data is not None:
-                save_path = os.path.join(CHAR_DIR, f"character_{i+1} {uuid.uuid4().hex}.jpg")
-                image = part.as_image()
-                image.save(save_path)
+                save_path = _save_part_image(part, os.path.join(CHAR_DIR, f"character_{i+1} {uuid.uuid4().hex}.png"))
     else:
         error= "the model did not return any picture."
     return save_path,error
 
-def regenerate_image_nanobanana(prompt, characters=None, ratio="1:1"):
+def regenerate_image_nanobanana(prompt, characters=None, ratio="1:1", use_cache=False, force_new=False):
     """
     Regenerates a single image based on the prompt and characters.
+    With use_cache an unchanged request is served from the image cache unless force_new is set.
     """
 
     output_dir = "images"
     os.makedirs(output_dir, exist_ok=True)
     
-    client = genai.Client()
-    parts = []
+    client = get_genai_client()
     error = ""
-    if characters:
-        desc_text = "Character descriptions to maintain consistency:\n"
-        for char in characters:
-            if char.get("name") or char.get("traits"):
-                desc_text += f"Character: {char.get('name', '')}\nTraits: {char.get('traits', '')}\n\n"
-            char_image = char.get("image")
-            if char_image:
-                char_file = client.files.upload(file=char_image)
-                parts.append(types.Part(
-                    file_data=types.FileData(
-                        file_uri=char_file.uri,
-                        mime_type=char_file.mime_type
-                    )
-                ))
-        
-        if desc_text.strip():
-            prompt = f"User Prompt :{prompt}"
-            prompt +=f" \n{desc_text}"
-
-    prompt += "No wording in the image. "
-    parts.append(types.Part(text=prompt))
+    cache_key = _page_cache_keys([prompt], characters, ratio)[0] if use_cache else None
+    if cache_key and not force_new:
+        cached_path = _cached_image(cache_key, f"output_{uuid.uuid4().hex}.png")
+        if cached_path:
+            return cached_path, error
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-image",
-        contents=parts,
-        config=types.GenerateContentConfig(
-            image_config=types.ImageConfig(aspect_ratio=ratio),
-            safety_settings= safety_settings
-        )
-    )
+    # Reuses the book's cached character context while it is alive.
+    response = _generate_with_context(client, characters, ratio, lambda context: _page_request_parts(context, prompt))
     save_path = None
     
     if getattr(response, "prompt_feedback", None) is not None:
@@ -216,12 +574,11 @@ def regenerate_image_nanobanana(prompt, characters=None, ratio="1:1"):
         for part in response.candidates[0].content.parts:
             if part.inline_data is not None:
                 unique_filename = f"output_{uuid.uuid4().hex}.png"
-                save_path = os.path.join(output_dir, unique_filename)
-                image = part.as_image()
-                image.save(save_path)
+                save_path = _save_part_image(part, os.path.join(output_dir, unique_filename))
                 break # Only save the first image found
     else:
         error= "the model did not return any picture."
+    _remember_image(cache_key, save_path)
     return save_path,error
 
 def regenerate_image_with_image_nanobanana(prompt, original_image_path, characters=None, ratio="1:1"):
@@ -231,48 +588,29 @@ def regenerate_image_with_image_nanobanana(prompt, original_image_path, characte
     output_dir = "images"
     os.makedirs(output_dir, exist_ok=True)
     
-    client = genai.Client()
-    parts = []
+    client = get_genai_client()
     error=""
-    if original_image_path and os.path.exists(original_image_path):
-        original_file = client.files.upload(file=original_image_path)
-        parts.append(types.Part(
-            file_data=types.FileData(
-                file_uri=original_file.uri,
-                mime_type=original_file.mime_type
-            )
-        ))
-        parts.append(types.Part(text="Edit the picture based on this picture"))
-    
-    if characters:
-        desc_text = "Character descriptions to maintain consistency:\n"
-        for char in characters:
-            if char.get("name") or char.get("traits"):
-                desc_text += f"Character: {char.get('name', '')}\nTraits: {char.get('traits', '')}\n\n"
-            
-            char_image = char.get("image")
-            if char_image:
-                char_file = client.files.upload(file=char_image)
-                parts.append(types.Part(
-                    file_data=types.FileData(
-                        file_uri=char_file.uri,
-                        mime_type=char_file.mime_type
-                    )
-                ))
-        
-        if desc_text.strip():
-            prompt = f"User Prompt :{prompt}"
-            prompt +=f" \n{desc_text}"
-
-    prompt += "No wording in the image. "
-    parts.append(types.Part(text=prompt))
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-image",
-        contents=parts,
-        config=types.GenerateContentConfig(
-            image_config=types.ImageConfig(aspect_ratio=ratio),
-            safety_settings= safety_settings
-        )
+    has_original = bool(original_image_path and os.path.exists(original_image_path))
+
+    def build_parts(context):
+        parts = []
+        if has_original:
+            original_file = upload_cache.get_uploaded_file(client, original_image_path)
+            parts.append(types.Part(
+                file_data=types.FileData(
+                    file_uri=original_file["uri"],
+                    mime_type=original_file["mime_type"]
+                )
+            ))
+            parts.append(types.Part(text="Edit the picture based on this picture"))
+        return parts + _page_request_parts(context, prompt)
+
+    response = _generate_with_context(
+        client,
+        characters,
+        ratio,
+        build_parts,
+        extra_uploads=[original_image_path] if has_original else [],
     )
 
     save_path = None
@@ -285,9 +623,7 @@ def regenerate_image_with_image_nanobanana(prompt, original_image_path, characte
         for part in response.candidates[0].content.parts:
             if part.inline_data is not None:
                 unique_filename = f"output_{uuid.uuid4().hex}.png"
-                save_path = os.path.join(output_dir, unique_filename)
-                image = part.as_image()
-                image.save(save_path)
+                save_path = _save_part_image(part, os.path.join(output_dir, unique_filename))
                 break # Only save the first image found
     else:
         error= "the model did not return any picture."
@@ -299,7 +635,7 @@ def regenerate_character_with_image_nanobanana(character_description, original_i
     """
     output_dir = "characters"
     os.makedirs(output_dir, exist_ok=True)
-    client = genai.Client()
+    client = get_genai_client()
 
     prompt = f"""
     You are a professional character designer for a {genre} storybook.
@@ -317,8 +653,10 @@ def regenerate_character_with_image_nanobanana(character_description, original_i
     error=""
     try:
         if os.path.exists(original_image_path):
-            image = Image.open(original_image_path)
-            parts.append(image)
+            # Sent as the file's own bytes; no decode and re-encode on the way.
+            with open(original_image_path, "rb") as f:
+                data = f.read()
+            parts.append(types.Part.from_bytes(data=data, mime_type=image_io.sniff_mime_type(data[:16]) or "image/png"))
             parts.append(types.Part(text="Edit the character based on this picture"))
         else:
             print(f"Error: Original image not found at {original_image_path}")
@@ -348,9 +686,7 @@ def regenerate_character_with_image_nanobanana(character_description, original_i
         for part in response.candidates[0].content.parts:
             if part.inline_data is not None:
                 unique_filename = f"character_regen_{uuid.uuid4().hex}.png"
-                save_path = os.path.join(output_dir, unique_filename)
-                image = part.as_image()
-                image.save(save_path)
+                save_path = _save_part_image(part, os.path.join(output_dir, unique_filename))
                 break 
     else:
         error= "the model did not return any picture."
@@ -0,0 +1,266 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+# Character and illustration jobs queued by the UI and run by worker.py, which
+# can run as several processes next to any number of UI replicas sharing this directory.
+QUEUE_DB = os.path.join(".cache", "jobs.sqlite3")
+# Jobs of one API key that may run at the same time across all workers.
+PER_KEY_CONCURRENCY = 2
+HEARTBEAT_SECONDS = 10
+# A running job whose worker hasn't checked in for this long is put back in the queue.
+STALE_SECONDS = 60
+MAX_ATTEMPTS = 3
+# A worker that checked in this recently is considered alive.
+WORKER_TTL_SECONDS = 30
+FINISHED_TTL_SECONDS = 7 * 24 * 60 * 60
+
+FINISHED_STATES = ("succeeded", "failed")
+# A job that handed its work to a batch job and waits for it outside any worker slot. It
+# doesn't count against the per-key limit and is queued again once the batch job is done.
+# Its worker column names the one worker that polls the batch job.
+WAITING_STATE = "waiting"
+
+
+@contextlib.contextmanager
+def _connect():
+    """Yields a connection, committing on success and always closing it."""
+    os.makedirs(os.path.dirname(QUEUE_DB), exist_ok=True)
+    created = not os.path.exists(QUEUE_DB)
+    conn = sqlite3.connect(QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        if created:
+            # Queued jobs carry the API key until they finish.
+            os.chmod(QUEUE_DB, 0o600)
+        _init_schema(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _init_schema(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            api_key TEXT,
+            params TEXT NOT NULL,
+            state TEXT NOT NULL,
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            heartbeat_at REAL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            pid INTEGER,
+            concurrency INTEGER,
+            last_seen REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at);
+        CREATE INDEX IF NOT EXISTS jobs_key_state ON jobs (key, state);
+    """)
+
+
+def _record(row):
+    if row is None:
+        return None
+    record = dict(row)
+    record.pop("api_key", None)
+    for field in ("params", "progress", "result"):
+        record[field] = json.loads(record[field]) if record[field] else None
+    return record
+
+
+def enqueue(kind, params, api_key, key):
+    """Queues a job of one of worker.HANDLERS' kinds. key is the API key's fingerprint. Returns the job id."""
+    job_id = f"jobs/{uuid.uuid4().hex[:12]}"
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, key, api_key, params, state, created_at) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+            (job_id, kind, key, api_key, json.dumps(params), time.time()),
+        )
+    return job_id
+
+
+def get_job(job_id):
+    """The job's record (without its API key), or None if it is unknown."""
+    with _connect() as conn:
+        return _record(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+
+def is_finished(record):
+    return bool(record) and record["state"] in FINISHED_STATES
+
+
+def queue_position(job_id):
+    """Number of queued jobs ahead of this one."""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND created_at < (SELECT created_at FROM jobs WHERE id = ?)",
+            (job_id,),
+        ).fetchone()
+    return row[0]
+
+
+def claim(worker_id, per_key=PER_KEY_CONCURRENCY):
+    """
+    Marks the oldest queued job whose key is below its concurrency limit as running on
+    this worker and returns (record, api_key), or None when nothing can run right now.
+    """
+    now = time.time()
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT * FROM jobs AS queued
+            WHERE state = 'queued'
+              AND (SELECT COUNT(*) FROM jobs AS running WHERE running.key = queued.key AND running.state = 'running') < ?
+            ORDER BY created_at LIMIT 1
+            """,
+            (per_key,),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, started_at = ?, heartbeat_at = ? WHERE id = ?",
+            (worker_id, now, now, row["id"]),
+        )
+        api_key = row["api_key"]
+        record = _record(row)
+    record.update(state="running", worker=worker_id, attempts=record["attempts"] + 1)
+    return record, api_key
+
+
+def heartbeat(worker_id, job_ids, concurrency=None):
+    """Records that the worker, its running jobs and the parked jobs it polls are alive."""
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, pid, concurrency, last_seen) VALUES (?, ?, ?, ?)",
+            (worker_id, os.getpid(), concurrency, now),
+        )
+        conn.executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            [(now, job_id, worker_id) for job_id in job_ids],
+        )
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE worker = ? AND state = ?", (now, worker_id, WAITING_STATE))
+
+
+def set_progress(job_id, **progress):
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+
+def finish(job_id, result):
+    _finish(job_id, "succeeded", result=json.dumps(result))
+
+
+def fail(job_id, error):
+    _finish(job_id, "failed", error=str(error))
+
+
+def _finish(job_id, state, result=None, error=None):
+    with _connect() as conn:
+        # The API key is dropped as soon as it is no longer needed.
+        conn.execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, api_key = NULL, finished_at = ? WHERE id = ?",
+            (state, result, error, time.time(), job_id),
+        )
+
+
+def wait_for_batch(job_id, batch_job, params):
+    """
+    Parks a running job until batch_job is done, freeing its worker and per-key slots.
+    params replace the job's parameters, so the next run continues where this one stopped.
+    The job's worker, which submitted batch_job and polls it, keeps owning it.
+    """
+    with _connect() as conn:
+        # The next run is the job's collect step, with attempts of its own.
+        conn.execute(
+            "UPDATE jobs SET state = ?, params = ?, progress = ?, attempts = 0, heartbeat_at = ? WHERE id = ?",
+            (WAITING_STATE, json.dumps(dict(params, batch_job=batch_job)), json.dumps({"stage": "batch", "batch_job": batch_job}),
+             time.time(), job_id),
+        )
+
+
+def waiting_jobs():
+    """[(job_id, batch_job, api_key)] of the jobs parked by wait_for_batch."""
+    with _connect() as conn:
+        rows = conn.execute("SELECT id, params, api_key FROM jobs WHERE state = ?", (WAITING_STATE,)).fetchall()
+    return [(row["id"], json.loads(row["params"]).get("batch_job"), row["api_key"]) for row in rows]
+
+
+def own_waiting_jobs(worker_id, stale_seconds=STALE_SECONDS):
+    """
+    Takes over the parked jobs nobody polls (their worker stopped checking in) and returns
+    [(job_id, batch_job, api_key)] of every parked job this worker owns.
+    """
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET worker = ?, heartbeat_at = ? WHERE state = ? AND (worker IS NULL OR heartbeat_at < ?)",
+            (worker_id, now, WAITING_STATE, now - stale_seconds),
+        )
+        rows = conn.execute("SELECT id, params, api_key FROM jobs WHERE state = ? AND worker = ?", (WAITING_STATE, worker_id)).fetchall()
+    return [(row["id"], json.loads(row["params"]).get("batch_job"), row["api_key"]) for row in rows]
+
+
+def wake(job_id):
+    """Queues a parked job again; its waiting time counts as queue time, so it runs ahead of newer jobs."""
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET state = 'queued' WHERE id = ? AND state = ?", (job_id, WAITING_STATE))
+
+
+def requeue_stale(stale_seconds=STALE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    Puts running jobs whose worker stopped checking in back in the queue, or fails them
+    after max_attempts. Returns the ids of the requeued jobs.
+    """
+    now = time.time()
+    with _connect() as conn:
+        stale = conn.execute(
+            "SELECT id, attempts FROM jobs WHERE state = 'running' AND heartbeat_at < ?",
+            (now - stale_seconds,),
+        ).fetchall()
+        requeued = [row["id"] for row in stale if row["attempts"] < max_attempts]
+        conn.executemany("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ?", [(job_id,) for job_id in requeued])
+        conn.executemany(
+            "UPDATE jobs SET state = 'failed', error = 'worker stopped responding', api_key = NULL, finished_at = ? WHERE id = ?",
+            [(now, row["id"]) for row in stale if row["attempts"] >= max_attempts],
+        )
+        conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - FINISHED_TTL_SECONDS,))
+        conn.execute("DELETE FROM workers WHERE last_seen < ?", (now - FINISHED_TTL_SECONDS,))
+    return requeued
+
+
+def workers_available(max_age=WORKER_TTL_SECONDS):
+    """True if a worker process checked in recently, so queued jobs will be picked up."""
+    if not os.path.exists(QUEUE_DB):
+        return False
+    with _connect() as conn:
+        row = conn.execute("SELECT COUNT(*) FROM workers WHERE last_seen > ?", (time.time() - max_age,)).fetchone()
+    return row[0] > 0
+
+
+def remove_worker(worker_id):
+    with _connect() as conn:
+        conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+        # Its parked jobs are taken over by the next worker that looks, without waiting to go stale.
+        conn.execute("UPDATE jobs SET worker = NULL WHERE worker = ? AND state = ?", (worker_id, WAITING_STATE))
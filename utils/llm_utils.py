@@ -1,16 +1,82 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
 from typing import List
+import functools
+import os
+import time
 from utils.model_story import Storybook, Story
+from utils.disk_cache import DiskCache, make_key
+from utils import tracing
+from utils.clients import get_structured_llm
 
-STORYBOOK_SCHEMA = Storybook.model_json_schema()
-STORY_SCHEMA =Story.model_json_schema()
-def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,story):
+LLM_MODEL = "gemini-2.0-flash"
+# Validated responses keyed by model, schema and the full rendered prompt.
+LLM_CACHE = DiskCache(os.path.join(".cache", "llm"), max_bytes=50 * 1024 * 1024, max_age=7 * 24 * 60 * 60, suffix=".json")
+
+@functools.lru_cache(maxsize=None)
+def _schema(model_cls):
+    """JSON schema of a response model, built on first use rather than at import."""
+    return model_cls.model_json_schema()
+
+def _invoke_structured(prompt, schema, model_cls, use_cache=True):
+    """
+    Invokes the LLM with structured output and returns the response as a dict
+    validated against model_cls. Validated responses are cached on disk.
+    """
+    key = make_key("llm", LLM_MODEL, schema, prompt)
+    if use_cache:
+        cached = LLM_CACHE.get_bytes(key)
+        if cached is not None:
+            try:
+                return model_cls.model_validate_json(cached).model_dump()
+            except ValueError:
+                pass
+    structured_llm = get_structured_llm(LLM_MODEL, schema)
+    with tracing.span("llm.invoke", model=LLM_MODEL, schema=model_cls.__name__, prompt_chars=len(prompt)):
+        response = structured_llm.invoke(prompt)
+    validated = model_cls.model_validate(response)
+    LLM_CACHE.put_bytes(key, validated.model_dump_json().encode("utf-8"))
+    return validated.model_dump()
+
+def _stream_structured(prompt, schema, model_cls, use_cache=True):
+    """
+    Like _invoke_structured, but yields partial dicts parsed from the JSON as it streams in.
+    The last item yielded is the validated response; a cached response is yielded on its own.
+    """
+    key = make_key("llm", LLM_MODEL, schema, prompt)
+    if use_cache:
+        cached = LLM_CACHE.get_bytes(key)
+        if cached is not None:
+            try:
+                yield model_cls.model_validate_json(cached).model_dump()
+                return
+            except ValueError:
+                pass
+    structured_llm = get_structured_llm(LLM_MODEL, schema)
+    response = None
+    # Recorded after the fact: a span can't stay open across the yields to the caller.
+    start, started = time.time(), time.perf_counter()
+    first_chunk = None
+    for response in structured_llm.stream(prompt):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - started
+        yield response
+    tracing.record("llm.stream", start, time.perf_counter() - started, model=LLM_MODEL, schema=model_cls.__name__,
+                   prompt_chars=len(prompt), first_chunk_seconds=first_chunk)
+    validated = model_cls.model_validate(response)
+    LLM_CACHE.put_bytes(key, validated.model_dump_json().encode("utf-8"))
+    yield validated.model_dump()
+
+def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,story,use_cache=True):
     """Generate a short story page and image prompt."""
-    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
+    return generate_page_prompt_range(title, genre, tone, art_style, pages, age, characters, story, 1, pages, use_cache=use_cache)
+
+def generate_page_prompt_range(title, genre, tone, art_style,pages,age,characters,story,first_page,last_page,use_cache=True):
+    """
+    Generate the text and image prompt of pages first_page..last_page (1-based, inclusive)
+    of a pages-long book, so a long book can be written in small groups that are
+    illustrated as soon as they arrive. Covering the whole range asks for the full book.
+    """
     story=story
-    structured_llm = llm.with_structured_output(
-        schema=STORYBOOK_SCHEMA, method="json_schema"
-    )
+    count = last_page - first_page + 1
     character_text = ""
     if characters:
         character_text = "Main Characters:\n"
@@ -24,6 +90,12 @@ def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,stor
             "- If characters appear in the scene, include them clearly in the image prompt, "
             "with specific attention to their pose, facial expression, and position.\n"
         )
+    page_range_text = ""
+    if count != pages:
+        page_range_text = (
+            f"The full book has {pages} pages: split the story into {pages} consecutive parts of similar length, one per page.\n"
+            f"    Only write pages {first_page} to {last_page} of the book, continuing seamlessly from page {first_page - 1} and into page {last_page + 1}.\n"
+        )
     prompt = f"""
     Generate image prompt for illustrated storybook titled "{title}".
     With story:{story}
@@ -38,7 +110,7 @@ def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,stor
     - A matching image prompt describing the scene using this art style: {art_style}.
     {include_character_in_prompt if characters else ''}
     - Make Sure the prompt is very detailed 5-6 sentences.
-    Generate exactly {pages} pages.
+    {page_range_text}Generate exactly {count} pages.
 
     Return the result in JSON format:
     {{
@@ -63,7 +135,7 @@ def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,stor
     }}
     """
 
-    response = structured_llm.invoke(prompt)
+    response = _invoke_structured(prompt, _schema(Storybook), Storybook, use_cache=use_cache)
     try:
 
         return response
@@ -78,26 +150,7 @@ def generate_page_prompt(title, genre, tone, art_style,pages,age,characters,stor
             ]
         }
     
-def generate_story_prompt(title, genre, tone, art_style,page,age):
-    """
-    Generate a natural-language prompt for the LLM to create a story.
-
-    Args:
-        title (str): The title of the story.
-        genre (str): The genre of the story (e.g., Fantasy, Adventure).
-        tone (str): The tone/mood of the story (e.g., Heartwarming, Whimsical).
-        art_style (str): Art style for illustrations (e.g., Watercolor, Cartoonish).
-        num_pages (int): Number of pages / story length.
-        characters (list of dict, optional): List of character dicts with 'name' and 'traits'.
-        audience (str, optional): Target audience or reading level.
-
-    Returns:
-        str: A formatted string prompt suitable for sending to an LLM.
-    """
-    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
-    structured_llm = llm.with_structured_output(
-        schema=STORY_SCHEMA, method="json_schema"
-    )
+def _story_prompt(title, genre, tone, art_style, page, age):
     prompt = f"""
     Write a {page}-page {genre} story titled '{title}'
     with a {tone.lower() if tone else 'neutral'} tone
@@ -131,8 +184,27 @@ def generate_story_prompt(title, genre, tone, art_style,page,age):
     ]
     }}
     """
+    return prompt
+
+def generate_story_prompt(title, genre, tone, art_style,page,age,use_cache=True):
+    """
+    Generate a natural-language prompt for the LLM to create a story.
 
-    response = structured_llm.invoke(prompt)
+    Args:
+        title (str): The title of the story.
+        genre (str): The genre of the story (e.g., Fantasy, Adventure).
+        tone (str): The tone/mood of the story (e.g., Heartwarming, Whimsical).
+        art_style (str): Art style for illustrations (e.g., Watercolor, Cartoonish).
+        num_pages (int): Number of pages / story length.
+        characters (list of dict, optional): List of character dicts with 'name' and 'traits'.
+        audience (str, optional): Target audience or reading level.
+        use_cache (bool): Serve an identical request from the on-disk response cache.
+
+    Returns:
+        str: A formatted string prompt suitable for sending to an LLM.
+    """
+    prompt = _story_prompt(title, genre, tone, art_style, page, age)
+    response = _invoke_structured(prompt, _schema(Story), Story, use_cache=use_cache)
     try:
         return response
     except Exception:
@@ -144,4 +216,13 @@ def generate_story_prompt(title, genre, tone, art_style,page,age):
                     "trait":"A lion, brave, black color, tall"
                 },
             ]
-        }
\ No newline at end of file
+        }
+
+def stream_story_prompt(title, genre, tone, art_style,page,age,use_cache=True):
+    """
+    Streaming variant of generate_story_prompt. Yields partial dicts (e.g. {"story": "Once upon"})
+    as the response streams in, so the story can be shown from the first tokens on; the last
+    item is the complete, validated Story with its characters.
+    """
+    prompt = _story_prompt(title, genre, tone, art_style, page, age)
+    yield from _stream_structured(prompt, _schema(Story), Story, use_cache=use_cache)
@@ -0,0 +1,104 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils import book_context, tracing
+from utils.clients import get_genai_client
+from utils.llm_utils import generate_page_prompt_range
+from utils.image_utils import IMAGE_MODEL, INTERACTIVE_MAX_WORKERS, generate_page_nanobanana
+
+# Page prompts are written in groups of this many pages, all groups in parallel, and each
+# page is illustrated as soon as its group arrives, so a book takes roughly one prompt
+# group plus one image instead of the whole prompt stage plus every image.
+PROMPT_GROUP_SIZE = 4
+PROMPT_MAX_WORKERS = 4
+
+
+def page_groups(num_pages, group_size=PROMPT_GROUP_SIZE):
+    """1-based (first_page, last_page) ranges covering the book."""
+    return [(first, min(first + group_size - 1, num_pages)) for first in range(1, num_pages + 1, group_size)]
+
+
+def _write_page_group(title, genre, tone, art_style, num_pages, age, characters, story, first, last, use_llm_cache):
+    expected = last - first + 1
+    with tracing.span("pipeline.page_group", first=first, last=last) as span:
+        storybook = generate_page_prompt_range(title, genre, tone, art_style, num_pages, age, characters, story, first, last, use_cache=use_llm_cache)
+        if len(storybook["pages"]) < expected:
+            # The model occasionally merges pages; ask once more before giving up on the group.
+            span.set(retried=True)
+            storybook = generate_page_prompt_range(title, genre, tone, art_style, num_pages, age, characters, story, first, last, use_cache=False)
+    if len(storybook["pages"]) < expected:
+        raise ValueError(f"Expected {expected} pages for pages {first}-{last}, got {len(storybook['pages'])}.")
+    return storybook["book_name"], storybook["pages"][:expected]
+
+
+def iter_book_pipeline(title, genre, tone, art_style, num_pages, age, characters, story, ratio="1:1",
+                       group_size=PROMPT_GROUP_SIZE, max_workers=INTERACTIVE_MAX_WORKERS, use_cache=False, use_llm_cache=True):
+    """
+    Writes the page prompts in groups and dispatches each page's illustration as soon as
+    its prompt exists. Yields events in completion order:
+        ("pages", first_index, book_name, pages)   -- a group of page dicts, 0-based first_index
+        ("image", page_index, img_path, error)     -- one finished illustration
+    A group whose prompts can't be written yields empty pages, each with a failed image
+    carrying the error, and the rest of the book goes on.
+    use_cache applies to the images (like generate_image_nanobanana's); the page prompts
+    come from the response cache unless use_llm_cache is False, as in generate_page_prompt.
+    """
+    client = get_genai_client()
+    # Upload the references and cache the shared character context once up front.
+    context = book_context.get_book_context(client, IMAGE_MODEL, characters, num_requests=num_pages)
+
+    groups = page_groups(num_pages, group_size)
+    group_sizes = {first - 1: last - first + 1 for first, last in groups}
+    prompt_pool = ThreadPoolExecutor(max_workers=min(PROMPT_MAX_WORKERS, max(1, len(groups))))
+    image_pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # Workers run in a copy of this context so they see the session's API key (see utils.clients).
+        pending = {
+            prompt_pool.submit(contextvars.copy_context().run, _write_page_group, title, genre, tone, art_style, num_pages, age, characters, story, first, last, use_llm_cache): ("pages", first - 1)
+            for first, last in groups
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, index = pending.pop(future)
+                if kind == "pages":
+                    try:
+                        book_name, pages = future.result()
+                    except Exception as e:
+                        print(f"Writing the prompts of pages {index + 1}-{index + group_sizes[index]} failed: {e}")
+                        yield "pages", index, "", [{"text": "", "image_prompt": ""} for _ in range(group_sizes[index])]
+                        for offset in range(group_sizes[index]):
+                            yield "image", index + offset, "", f"the page prompt could not be written: {e}"
+                        continue
+                    yield "pages", index, book_name, pages
+                    for offset, page in enumerate(pages):
+                        image_future = image_pool.submit(contextvars.copy_context().run, generate_page_nanobanana, index + offset, page["image_prompt"], characters, ratio, use_cache, False, context)
+                        pending[image_future] = ("image", index + offset)
+                else:
+                    img_path, error = future.result()
+                    yield "image", index, img_path, error
+    finally:
+        # If the consumer stops early (e.g. a Streamlit rerun), drop the work not started yet.
+        prompt_pool.shutdown(wait=False, cancel_futures=True)
+        image_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_book_pipelined(title, genre, tone, art_style, num_pages, age, characters, story, ratio="1:1",
+                            group_size=PROMPT_GROUP_SIZE, max_workers=INTERACTIVE_MAX_WORKERS, use_cache=False, use_llm_cache=True):
+    """
+    Runs iter_book_pipeline to completion. Returns (story_data, img_paths, errors) with
+    story_data shaped like generate_page_prompt's result.
+    """
+    book_name = ""
+    pages = [None] * num_pages
+    img_paths = [""] * num_pages
+    errors = [""] * num_pages
+    for event in iter_book_pipeline(title, genre, tone, art_style, num_pages, age, characters, story, ratio,
+                                    group_size=group_size, max_workers=max_workers, use_cache=use_cache, use_llm_cache=use_llm_cache):
+        if event[0] == "pages":
+            _, first, name, group = event
+            if name and (first == 0 or not book_name):
+                book_name = name
+            pages[first:first + len(group)] = group
+        else:
+            _, index, img_paths[index], errors[index] = event
+    return {"book_name": book_name, "pages": pages}, img_paths, errors
@@ -0,0 +1,105 @@
+import os
+import threading
+from concurrent.futures import Future
+from utils import image_io, tracing
+from utils.upload_cache import file_sha256
+
+PREVIEW_DIR = os.path.join(".cache", "previews")
+# Pages are shown at 400 px and characters at 300 px; 2x keeps them sharp on HiDPI screens.
+PREVIEW_MAX_SIDE = 800
+PREVIEW_QUALITY = 80
+
+_lock = threading.Lock()
+# (path, mtime_ns, size) -> Future of the preview path, so reruns don't re-hash the originals
+# and a page shown while its preview is still rendering waits for that render.
+_previews = {}
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _render_preview(path, preview, max_side):
+    # Runs in the encoding pool (see utils.image_io).
+    from PIL import Image
+    with tracing.span("image.preview", path=path, bytes=os.path.getsize(path)), Image.open(path) as image:
+        image.thumbnail((max_side, max_side))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        os.makedirs(PREVIEW_DIR, exist_ok=True)
+        tmp_path = f"{preview}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="WEBP", quality=PREVIEW_QUALITY)
+    os.replace(tmp_path, preview)
+    return preview
+
+
+def _usable(future):
+    if not future.done():
+        return True
+    return future.exception() is None and os.path.exists(future.result())
+
+
+def _preview_future(path, max_side):
+    """The pending or finished render of a preview; renders already on disk resolve at once."""
+    stat_key = _stat_key(path)
+    with _lock:
+        cached = _previews.get(stat_key)
+    if cached is not None and _usable(cached):
+        return cached
+    preview = os.path.join(PREVIEW_DIR, f"{file_sha256(path)}_{max_side}.webp")
+    if os.path.exists(preview):
+        future = Future()
+        future.set_result(preview)
+    else:
+        future = image_io.submit(_render_preview, path, preview, max_side)
+    with _lock:
+        _previews[stat_key] = future
+    return future
+
+
+def schedule_preview(path, max_side=PREVIEW_MAX_SIDE):
+    """Starts rendering the preview of a freshly written image without waiting for it."""
+    try:
+        _preview_future(path, max_side)
+    except OSError as e:
+        print(f"Could not schedule preview for {path}: {e}")
+
+
+def make_preview(path, max_side=PREVIEW_MAX_SIDE):
+    """
+    Creates a downscaled WebP preview of an image, stored by the hash of the source
+    content, and returns its path. Returns the original path if it can't be previewed.
+    """
+    try:
+        future = _preview_future(path, max_side)
+    except OSError:
+        return path
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Could not create preview for {path}: {e}")
+        return path
+
+
+def preview_path(path):
+    """Preview to display for an asset; the original is kept for export."""
+    if not path:
+        return path
+    return make_preview(path)
+
+
+def remove_previews(path, max_sides=(PREVIEW_MAX_SIDE,)):
+    """
+    Deletes the previews of an image that is about to be deleted. Previews are shared by
+    images with the same content; one that is still shown elsewhere is simply rendered again.
+    """
+    try:
+        digest = file_sha256(path)
+    except OSError:
+        return
+    for max_side in max_sides:
+        try:
+            os.remove(os.path.join(PREVIEW_DIR, f"{digest}_{max_side}.webp"))
+        except OSError:
+            pass
@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import threading
+import time
+from utils import asset_store, file_lock
+from utils.upload_cache import file_sha256
+
+# A book is saved as one compact JSON manifest: settings, story, characters, page text and
+# prompts, the images' paths and content hashes, and the ids of jobs still producing
+# images. It is rewritten after every stage, so a restarted server or an expired session
+# reopens the book from the manifest alone; images are read only when a page is shown.
+PROJECTS_DIR = "projects"
+INDEX_FILE = os.path.join(PROJECTS_DIR, "index.json")
+MANIFEST_VERSION = 1
+
+_lock = threading.Lock()
+
+
+def is_valid_project_id(project_id):
+    """Project ids come from URLs and manifests; only plain names may become file names."""
+    return isinstance(project_id, str) and re.fullmatch(r"[0-9A-Za-z_-]+", project_id) is not None
+
+
+def _manifest_path(project_id):
+    if not is_valid_project_id(project_id):
+        raise ValueError(f"Invalid project id {project_id!r}")
+    return os.path.join(PROJECTS_DIR, f"{project_id}.json")
+
+
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json(path, data):
+    os.makedirs(PROJECTS_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _asset(path, previous):
+    """{"path", "sha256", "size", "mtime_ns"} of an image; the hash is reused while the file is unchanged."""
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if previous and previous.get("path") == path and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous
+    return {"path": path, "sha256": file_sha256(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _asset_paths(manifest):
+    entries = [page.get("image") for page in manifest.get("pages", [])] + [char.get("image") for char in manifest.get("characters", [])]
+    return sorted(entry["path"] for entry in entries if entry)
+
+
+def save_project(project_id, title="", settings=None, story="", characters=None, story_data=None,
+                 img_paths=None, errors=None, jobs=None):
+    """
+    Writes the manifest of a book from the session's state. Cheap to call repeatedly:
+    unchanged images are not re-hashed and asset references are only updated when they change.
+    """
+    with file_lock.locked(INDEX_FILE, _lock):
+        previous = _read_json(_manifest_path(project_id), {})
+        previous_pages = previous.get("pages", [])
+        previous_characters = previous.get("characters", [])
+        img_paths = img_paths or []
+        errors = errors or []
+        pages = []
+        for i, page in enumerate((story_data or {}).get("pages") or []):
+            if page is None:
+                page = {}
+            previous_image = previous_pages[i].get("image") if i < len(previous_pages) else None
+            pages.append({
+                "text": page.get("text", ""),
+                "image_prompt": page.get("image_prompt", ""),
+                "image": _asset(img_paths[i] if i < len(img_paths) else "", previous_image),
+                "error": str(errors[i]) if i < len(errors) and errors[i] else "",
+            })
+        character_entries = []
+        for i, char in enumerate(characters or []):
+            previous_image = previous_characters[i].get("image") if i < len(previous_characters) else None
+            character_entries.append({
+                "name": char.get("name", ""),
+                "traits": char.get("traits", ""),
+                "image": _asset(char.get("image"), previous_image),
+            })
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "id": project_id,
+            "title": title,
+            "settings": settings or {},
+            "story": story,
+            "characters": character_entries,
+            "book_name": (story_data or {}).get("book_name", ""),
+            "pages": pages,
+            "jobs": jobs or {},
+            "created_at": previous.get("created_at", time.time()),
+            "updated_at": time.time(),
+        }
+        _write_json(_manifest_path(project_id), manifest)
+        index = _read_json(INDEX_FILE, {})
+        index[project_id] = {
+            "title": title or manifest["book_name"] or "Untitled",
+            "pages": len(pages),
+            "updated_at": manifest["updated_at"],
+        }
+        _write_json(INDEX_FILE, index)
+    # Saved books keep their images however long nobody opens them.
+    if _asset_paths(manifest) != _asset_paths(previous):
+        asset_store.set_project_references(project_id, _asset_paths(manifest))
+    return manifest
+
+
+def load_project(project_id):
+    """
+    Reads a book back as the session's state, or returns None if there is no such project.
+    Only the manifest is read; missing images come back as "" with an error for their page.
+    """
+    if not is_valid_project_id(project_id):
+        return None
+    manifest = _read_json(_manifest_path(project_id), None)
+    if not manifest or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    pages = manifest.get("pages", [])
+    img_paths = []
+    errors = []
+    for page in pages:
+        image = page.get("image")
+        # A stat per page, no reads: the image itself is opened when its page is shown.
+        if image and os.path.exists(image["path"]):
+            img_paths.append(image["path"])
+            errors.append(page.get("error", ""))
+        else:
+            img_paths.append("")
+            errors.append(page.get("error") or ("image file is missing" if image else ""))
+    characters = [
+        {"name": char["name"], "traits": char["traits"],
+         "image": char["image"]["path"] if char.get("image") and os.path.exists(char["image"]["path"]) else None}
+        for char in manifest.get("characters", [])
+    ]
+    return {
+        "title": manifest.get("title", ""),
+        "settings": manifest.get("settings", {}),
+        "story": manifest.get("story", ""),
+        "characters": characters,
+        "story_data": {"book_name": manifest.get("book_name", ""),
+                       "pages": [{"text": page["text"], "image_prompt": page["image_prompt"]} for page in pages]} if pages else None,
+        "img_paths": img_paths,
+        "errors": errors,
+        "jobs": manifest.get("jobs", {}),
+    }
+
+
+def list_projects():
+    """[(project_id, {"title", "pages", "updated_at"})], most recently updated first."""
+    index = _read_json(INDEX_FILE, {})
+    return sorted(((project_id, info) for project_id, info in index.items() if is_valid_project_id(project_id)),
+                  key=lambda item: -item[1].get("updated_at", 0))
+
+
+def delete_project(project_id):
+    with file_lock.locked(INDEX_FILE, _lock):
+        try:
+            os.remove(_manifest_path(project_id))
+        except OSError:
+            pass
+        index = _read_json(INDEX_FILE, {})
+        if index.pop(project_id, None) is not None:
+            _write_json(INDEX_FILE, index)
+    asset_store.set_project_references(project_id, [])
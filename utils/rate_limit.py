@@ -0,0 +1,195 @@
+import os
+import random
+import threading
+import time
+from utils import tracing
+
+# One limiter per API key and model, shared by every session and thread of the process.
+# Each is a token bucket (requests per second) plus a cap on requests in flight. Both grow
+# additively while calls succeed and are halved when the API answers 429/503
+# (additive-increase/multiplicative-decrease), so throughput settles just below what the
+# key sustains instead of collapsing into a cascade of failures. Failed calls are retried
+# with full-jitter exponential backoff, honouring the server's retry delay.
+# The bucket starts open and only binds once the API has pushed back.
+MAX_RATE = 50.0
+INITIAL_RATE = MAX_RATE
+MIN_RATE = 0.05
+RATE_INCREASE = 0.05
+BURST = 8
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+DECREASE_FACTOR = 0.5
+# Throttles of requests that were already in flight belong to the same congestion event.
+DECREASE_COOLDOWN_SECONDS = 2.0
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_enabled = os.environ.get("STORYBOOK_RATE_LIMIT", "1").lower() not in ("0", "false", "no", "off")
+_lock = threading.Lock()
+_limiters = {}
+
+
+def _status(e):
+    # genai errors.APIError and google.api_core exceptions both carry the HTTP status as .code.
+    code = getattr(e, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def _retry_after(e):
+    """The server's suggested retry delay in seconds (RetryInfo / retry_after), or None."""
+    delay = getattr(e, "retry_after", None)
+    if isinstance(delay, (int, float)):
+        return float(delay)
+    details = getattr(e, "details", None)
+    if isinstance(details, dict):
+        details = details.get("error", details).get("details")
+    for detail in details if isinstance(details, list) else []:
+        if isinstance(detail, dict) and str(detail.get("retryDelay", "")).endswith("s"):
+            try:
+                return float(detail["retryDelay"][:-1])
+            except ValueError:
+                pass
+    return None
+
+
+class AdaptiveLimiter:
+    def __init__(self, name, rate=INITIAL_RATE, concurrency=INITIAL_CONCURRENCY):
+        self.name = name
+        self.rate = rate
+        self.limit = float(concurrency)
+        self.tokens = float(BURST)
+        self.in_flight = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(BURST, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Blocks until a token and an in-flight slot are free."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.in_flight < int(self.limit) and self.tokens >= 1:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        return
+                    # Out of slots: a release notifies. Out of tokens: wait for the next one.
+                    wait = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+                self._cond.wait(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + min(retry_after, BACKOFF_MAX_SECONDS))
+                if now - self._last_decrease >= DECREASE_COOLDOWN_SECONDS:
+                    self._last_decrease = now
+                    self.limit = max(MIN_CONCURRENCY, self.limit * DECREASE_FACTOR)
+                    self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+                    print(f"Rate limit hit for {self.name}: now {self.rate:.2f} req/s, {int(self.limit)} in flight")
+            else:
+                self.limit = min(MAX_CONCURRENCY, self.limit + 1 / self.limit)
+                self.rate = min(MAX_RATE, self.rate + RATE_INCREASE)
+            self._cond.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn under the limiter, retrying retryable API errors with jittered backoff."""
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status = _status(e)
+                retry_after = _retry_after(e)
+                self.release(throttled=status in THROTTLE_STATUSES, retry_after=retry_after)
+                if status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    raise
+                delay = max(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)), retry_after or 0)
+                print(f"{self.name}: {status}, retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES})")
+                tracing.record("ratelimit.retry", time.time(), delay, limiter=self.name, status=status, attempt=attempt + 1)
+                time.sleep(delay)
+                continue
+            self.release()
+            return result
+
+    def stats(self):
+        with self._cond:
+            return {"rate": self.rate, "concurrency": int(self.limit), "in_flight": self.in_flight, "throttled": self.throttled}
+
+
+def get_limiter(fingerprint, model):
+    with _lock:
+        limiter = _limiters.get((fingerprint, model))
+        if limiter is None:
+            limiter = _limiters[(fingerprint, model)] = AdaptiveLimiter(f"{model} ({fingerprint[:6]})")
+        return limiter
+
+
+def _model_of(kwargs):
+    model = str(kwargs.get("model", ""))
+    return model[len("models/"):] if model.startswith("models/") else model
+
+
+def limited(fingerprint, model_of, fn):
+    """Wraps fn so each call goes through the limiter of fingerprint and model_of(kwargs)."""
+    if not _enabled:
+        return fn
+
+    def wrapper(*args, **kwargs):
+        return get_limiter(fingerprint, model_of(kwargs)).call(fn, *args, **kwargs)
+    return wrapper
+
+
+def limit_genai_client(client, fingerprint):
+    """Routes the client's generate, upload and context caching calls through the key's limiters."""
+    client.models.generate_content = limited(fingerprint, _model_of, client.models.generate_content)
+    client.files.upload = limited(fingerprint, lambda kwargs: "files", client.files.upload)
+    client.caches.create = limited(fingerprint, _model_of, client.caches.create)
+    return client
+
+
+_END = object()
+
+
+class LimitedRunnable:
+    """A LangChain runnable whose invoke and stream calls go through a limiter."""
+    def __init__(self, runnable, limiter):
+        self.runnable = runnable
+        self.limiter = limiter
+
+    def invoke(self, input):
+        return self.limiter.call(self.runnable.invoke, input)
+
+    def stream(self, input):
+        # Retried until the first chunk arrives; the slot is held for that part only,
+        # a failure mid-stream is raised to the caller.
+        def open_stream():
+            iterator = iter(self.runnable.stream(input))
+            return iterator, next(iterator, _END)
+
+        iterator, first = self.limiter.call(open_stream)
+        if first is _END:
+            return
+        yield first
+        yield from iterator
+
+
+def limit_runnable(runnable, fingerprint, model):
+    if not _enabled:
+        return runnable
+    return LimitedRunnable(runnable, get_limiter(fingerprint, model))
@@ -0,0 +1,299 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+# Timed spans for API calls, uploads, polls, LLM calls, image writes and exports.
+# Finished spans are appended to TRACE_FILE as JSON lines and aggregated into a
+# Prometheus text file; STORYBOOK_TRACING=0 turns all of it into a no-op.
+# The metrics file holds one process's counters and is rewritten by that process only:
+# the app owns METRICS_FILE, other processes call use_process_metrics_file or export nothing.
+TRACE_DIR = os.path.join(".cache", "traces")
+TRACE_FILE = os.path.join(TRACE_DIR, "spans.jsonl")
+METRICS_FILE = os.path.join(TRACE_DIR, "metrics.prom")
+TRACE_MAX_BYTES = 50 * 1024 * 1024
+METRICS_FLUSH_SECONDS = 5
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_enabled = os.environ.get("STORYBOOK_TRACING", "1").lower() not in ("0", "false", "no", "off")
+_current_span = contextvars.ContextVar("current_span", default=None)
+_lock = threading.Lock()
+_metrics = {}
+_metrics_flushed_at = 0.0
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(value):
+    global _enabled
+    _enabled = bool(value)
+
+
+def set_metrics_file(path):
+    """Where this process exports its metrics; None turns the export off, e.g. in pool workers."""
+    global METRICS_FILE
+    with _lock:
+        METRICS_FILE = path
+
+
+def use_process_metrics_file(role, keep=False):
+    """
+    Exports this process's metrics to its own file. Unless keep is set (e.g. for a
+    one-off run whose totals are read afterwards) the file is removed when the process exits.
+    """
+    path = os.path.join(TRACE_DIR, f"metrics-{role}-{os.getpid()}.prom")
+    set_metrics_file(path)
+    if keep:
+        return
+
+    def remove():
+        set_metrics_file(None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    # atexit runs this before flush_metrics, which then has nothing to write.
+    atexit.register(remove)
+
+
+class Span:
+    def __init__(self, name, attributes):
+        parent = _current_span.get()
+        self.name = name
+        self.attributes = dict(attributes)
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, duration, error):
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": duration,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+        }
+        if error:
+            record["error"] = error
+        return record
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block. Yields the span so attributes known only afterwards
+    (bytes, job state, ...) can be added with span.set(...).
+    Spans opened inside another span in the same context become its children.
+    """
+    if not _enabled:
+        yield _NOOP_SPAN
+        return
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(current, time.perf_counter() - current._start_perf, error)
+
+
+def record(name, start, duration, error=None, **attributes):
+    """Records an already finished operation, for work that can't sit inside a with block (e.g. a stream)."""
+    if not _enabled:
+        return
+    current = Span(name, attributes)
+    current.start = start
+    _finish(current, duration, error)
+
+
+def traced(name, attributes=None):
+    """
+    Decorator form of span(). attributes(args, kwargs, result) may return extra
+    attributes derived from the call and its result.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name) as current:
+                result = fn(*args, **kwargs)
+                if attributes is not None and _enabled:
+                    try:
+                        current.set(**attributes(args, kwargs, result))
+                    except Exception as e:
+                        # Instrumentation must never break the call it measures.
+                        current.set(attributes_error=str(e))
+                return result
+        return wrapper
+    return decorator
+
+
+def _response_attributes(args, kwargs, response):
+    attributes = {"model": kwargs.get("model")}
+    if getattr(response, "prompt_feedback", None) is not None and response.prompt_feedback.block_reason is not None:
+        attributes["block_reason"] = str(response.prompt_feedback.block_reason)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        attributes["prompt_tokens"] = usage.prompt_token_count
+        attributes["cached_tokens"] = usage.cached_content_token_count
+    candidates = getattr(response, "candidates", None) or []
+    if candidates:
+        attributes["finish_reason"] = str(candidates[0].finish_reason)
+        parts = (candidates[0].content.parts if candidates[0].content else None) or []
+        attributes["bytes"] = sum(len(part.inline_data.data or b"") for part in parts if part.inline_data is not None)
+    return attributes
+
+
+def _upload_attributes(args, kwargs, uploaded):
+    path = kwargs.get("file")
+    return {
+        "bytes": os.path.getsize(path) if isinstance(path, str) else None,
+        "mime_type": getattr(uploaded, "mime_type", None),
+    }
+
+
+def _batch_attributes(args, kwargs, batch_job):
+    src = kwargs.get("src")
+    return {
+        "model": kwargs.get("model"),
+        "job": batch_job.name,
+        "state": batch_job.state.name if batch_job.state else None,
+        "requests": len(src) if isinstance(src, list) else None,
+        "src_file": src if isinstance(src, str) else None,
+    }
+
+
+def _cache_attributes(args, kwargs, cached):
+    usage = getattr(cached, "usage_metadata", None)
+    return {
+        "model": kwargs.get("model"),
+        "cache": cached.name,
+        "tokens": getattr(usage, "total_token_count", None),
+    }
+
+
+def instrument_genai_client(client):
+    """Wraps the genai calls the app makes (generate, upload, download, batch create/poll, context caching) in spans."""
+    client.models.generate_content = traced("genai.generate_content", _response_attributes)(client.models.generate_content)
+    client.files.upload = traced("genai.files.upload", _upload_attributes)(client.files.upload)
+    client.files.download = traced("genai.files.download", lambda args, kwargs, data: {"bytes": len(data)})(client.files.download)
+    client.batches.create = traced("genai.batches.create", _batch_attributes)(client.batches.create)
+    client.batches.get = traced("genai.batches.get", _batch_attributes)(client.batches.get)
+    client.caches.create = traced("genai.caches.create", _cache_attributes)(client.caches.create)
+    return client
+
+
+def _finish(current, duration, error):
+    record = current.to_dict(duration, error)
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        _record_metrics(current, duration, error)
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Writing trace failed: {e}")
+        if time.time() - _metrics_flushed_at >= METRICS_FLUSH_SECONDS:
+            _write_metrics()
+
+
+def _record_metrics(current, duration, error):
+    entry = _metrics.setdefault(current.name, {"count": 0, "errors": 0, "sum": 0.0, "bytes": 0, "buckets": [0] * len(DURATION_BUCKETS)})
+    entry["count"] += 1
+    entry["sum"] += duration
+    if error:
+        entry["errors"] += 1
+    size = current.attributes.get("bytes")
+    if isinstance(size, (int, float)):
+        entry["bytes"] += size
+    # Cumulative, as Prometheus histograms expect.
+    for i, bound in enumerate(DURATION_BUCKETS):
+        if duration <= bound:
+            entry["buckets"][i] += 1
+
+
+def summary():
+    """{span name: {"count", "seconds", "errors", "bytes"}} for this process."""
+    with _lock:
+        return {name: {"count": entry["count"], "seconds": entry["sum"], "errors": entry["errors"], "bytes": entry["bytes"]}
+                for name, entry in _metrics.items()}
+
+
+def metrics_text():
+    """The aggregated span metrics of this process in the Prometheus text format."""
+    with _lock:
+        return _metrics_text()
+
+
+def _metrics_text():
+    lines = [
+        "# HELP storybook_span_seconds Duration of traced operations.",
+        "# TYPE storybook_span_seconds histogram",
+    ]
+    for name, entry in sorted(_metrics.items()):
+        for bound, count in zip(DURATION_BUCKETS, entry["buckets"]):
+            lines.append(f'storybook_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+        lines.append(f'storybook_span_seconds_bucket{{span="{name}",le="+Inf"}} {entry["count"]}')
+        lines.append(f'storybook_span_seconds_sum{{span="{name}"}} {entry["sum"]:.6f}')
+        lines.append(f'storybook_span_seconds_count{{span="{name}"}} {entry["count"]}')
+    lines += ["# HELP storybook_span_errors_total Traced operations that raised.", "# TYPE storybook_span_errors_total counter"]
+    lines += [f'storybook_span_errors_total{{span="{name}"}} {entry["errors"]}' for name, entry in sorted(_metrics.items())]
+    lines += ["# HELP storybook_span_bytes_total Bytes read, written or sent by traced operations.", "# TYPE storybook_span_bytes_total counter"]
+    lines += [f'storybook_span_bytes_total{{span="{name}"}} {entry["bytes"]}' for name, entry in sorted(_metrics.items()) if entry["bytes"]]
+    return "\n".join(lines) + "\n"
+
+
+def _write_metrics():
+    # Called with _lock held.
+    global _metrics_flushed_at
+    _metrics_flushed_at = time.time()
+    if METRICS_FILE is None:
+        return
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        tmp_path = f"{METRICS_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(_metrics_text())
+        os.replace(tmp_path, METRICS_FILE)
+    except OSError as e:
+        print(f"Writing metrics failed: {e}")
+
+
+def flush_metrics():
+    if not _enabled:
+        return
+    with _lock:
+        if _metrics:
+            _write_metrics()
+
+
+atexit.register(flush_metrics)
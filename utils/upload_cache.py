@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from utils import file_lock
+from utils.clients import client_fingerprint
+
+# The Files API deletes uploads after 48 hours. Callers that need a file for longer than
+# a request (a batch job can queue for up to a day) pass the time it must still be alive
+# as min_remaining, and files closer to expiry are uploaded again.
+UPLOAD_TTL_SECONDS = 47 * 60 * 60
+EXPIRY_MARGIN_SECONDS = 60 * 60
+CACHE_DIR = ".cache"
+CACHE_FILE = os.path.join(CACHE_DIR, "uploads.json")
+
+_lock = threading.Lock()
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cache_key(client, path):
+    # Uploaded files belong to the project of the API key, so entries are
+    # scoped per key and a uri is never reused with a different key.
+    return f"{client_fingerprint(client)}:{file_sha256(path)}"
+
+
+def _load():
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(entries):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, CACHE_FILE)
+
+
+def _evict_expired(entries, now):
+    return {k: v for k, v in entries.items() if v.get("expires_at", 0) > now}
+
+
+def _expires_at(uploaded, now):
+    expiration = getattr(uploaded, "expiration_time", None)
+    if expiration is not None:
+        return min(expiration.timestamp() - EXPIRY_MARGIN_SECONDS, now + UPLOAD_TTL_SECONDS)
+    return now + UPLOAD_TTL_SECONDS
+
+
+def get_uploaded_file(client, path, min_remaining=0):
+    """
+    Returns {"uri", "mime_type"} for a local file, uploading it only when no upload of
+    the same content exists for the current API key that lives another min_remaining seconds.
+    """
+    key = _cache_key(client, path)
+    now = time.time()
+    with _lock:
+        entries = _load()
+        entry = entries.get(key)
+        if entry and entry.get("expires_at", 0) > now + min_remaining:
+            return {"uri": entry["uri"], "mime_type": entry["mime_type"]}
+
+    uploaded = client.files.upload(file=path)
+    entry = {
+        "name": uploaded.name,
+        "uri": uploaded.uri,
+        "mime_type": uploaded.mime_type,
+        "expires_at": _expires_at(uploaded, now),
+    }
+    with file_lock.locked(CACHE_FILE, _lock):
+        entries = _evict_expired(_load(), now)
+        entries[key] = entry
+        _save(entries)
+    return {"uri": entry["uri"], "mime_type": entry["mime_type"]}
+
+
+def invalidate(client, paths):
+    """Drops cached uploads for the given local files, e.g. after the API rejected their uri."""
+    keys = set()
+    for path in paths:
+        if path and os.path.exists(path):
+            keys.add(_cache_key(client, path))
+    if not keys:
+        return
+    with file_lock.locked(CACHE_FILE, _lock):
+        entries = _load()
+        for key in keys:
+            entries.pop(key, None)
+        _save(entries)
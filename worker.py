@@ -0,0 +1,221 @@
+"""
+Headless worker for the job queue in utils/job_queue.py.
+
+Runs the character and illustration jobs that main.py queues while a worker
+is alive, so a long generation never ties up a Streamlit session. Start any number
+of workers from the app directory; they share .cache/, images/ and characters/ with
+the UI, and the per-API-key limit holds across all of them:
+
+    python worker.py
+    python worker.py --concurrency 8 --per-key 2
+"""
+import argparse
+import contextvars
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from utils import job_queue, tracing
+from utils.clients import set_current_api_key
+
+WORKER_CONCURRENCY = 4
+POLL_SECONDS = 1.0
+
+BOOK_FIELDS = ("title", "genre", "tone", "art_style", "num_pages", "age", "characters", "story")
+# Returned by a handler that parked its job with job_queue.wait_for_batch.
+WAITING = object()
+
+
+def _error_texts(errors):
+    # Block reasons are enums; the queue stores JSON.
+    return [str(error) if error else "" for error in errors]
+
+
+def run_character(job_id, params):
+    from utils.image_utils import generate_character_nanobanana
+    path, error = generate_character_nanobanana([params["description"]], params["genre"], params["tone"], params["art_style"], params["index"], params["ratio"])
+    return {"path": path or "", "error": str(error) if error else ""}
+
+
+def run_images(job_id, params):
+    """
+    Page prompts and illustrations of a book. Interactive books report per-page progress;
+    batch books are parked while their batch job runs and collected by a later run, which
+    parks them again with a follow-up batch of the failed pages (up to FAILED_PAGE_RETRIES).
+    """
+    from utils import batch_jobs
+    from utils.image_utils import FAILED_PAGE_RETRIES, choose_execution_mode, failed_pages, retry_failed_pages, submit_image_job
+    from utils.llm_utils import generate_page_prompt
+    from utils.pipeline import iter_book_pipeline
+    book = [params[name] for name in BOOK_FIELDS]
+    num_pages, characters = params["num_pages"], params["characters"]
+    ratio, use_cache = params.get("ratio", "1:1"), params.get("use_cache", False)
+    mode = params.get("mode", "auto")
+    if mode == "auto":
+        mode = choose_execution_mode(num_pages)
+
+    if mode == "interactive":
+        pages = [None] * num_pages
+        img_paths = [""] * num_pages
+        errors = [""] * num_pages
+        book_name = ""
+        done = 0
+        for event in iter_book_pipeline(*book, ratio=ratio, use_cache=use_cache):
+            if event[0] == "pages":
+                _, first, name, group = event
+                if name and (first == 0 or not book_name):
+                    book_name = name
+                pages[first:first + len(group)] = group
+                continue
+            _, idx, img_paths[idx], errors[idx] = event
+            done += 1
+            job_queue.set_progress(job_id, stage="images", done=done, total=num_pages)
+        story_data = {"book_name": book_name, "pages": pages}
+    elif not params.get("batch_job"):
+        job_queue.set_progress(job_id, stage="page_prompts")
+        story_data = generate_page_prompt(*book)
+        prompts = [page["image_prompt"] for page in story_data["pages"]]
+        batch_job, img_paths = submit_image_job(prompts, characters=characters, ratio=ratio, metadata={"queue_job": job_id}, use_cache=use_cache)
+        if batch_job is not None:
+            # A batch job can sit in the API's queue for hours; waiting for it must not hold a slot.
+            job_queue.wait_for_batch(job_id, batch_job, dict(params, mode="batch", story_data=story_data))
+            return WAITING
+        errors = [""] * len(prompts)
+    else:
+        story_data = params["story_data"]
+        record = batch_jobs.get_job(params["batch_job"])
+        if not batch_jobs.is_finished(record):
+            raise RuntimeError(f"Batch job {params['batch_job']} did not finish: {(record or {}).get('poll_error', 'unknown job')}")
+        img_paths, errors = record["img_paths"], record["errors"]
+        prompts = [page["image_prompt"] for page in story_data["pages"]]
+        attempt = params.get("retry_attempt", 0)
+        failed = [i for i in failed_pages(img_paths, len(prompts)) if prompts[i]]
+        if failed and attempt < FAILED_PAGE_RETRIES:
+            retry_job, _ = submit_image_job(prompts, characters=characters, ratio=ratio, metadata={"queue_job": job_id},
+                                            use_cache=use_cache, force_new=True, base_paths=img_paths)
+            print(f"Retrying {len(failed)} failed pages of job {job_id} (attempt {attempt + 1}/{FAILED_PAGE_RETRIES})")
+            job_queue.wait_for_batch(job_id, retry_job, dict(params, retry_attempt=attempt + 1))
+            return WAITING
+        return {"story_data": story_data, "img_paths": list(img_paths), "errors": _error_texts(errors)}
+    # Retries run here, in this job's slot, so they must not turn into a batch job to wait for.
+    img_paths, errors = retry_failed_pages([page["image_prompt"] for page in story_data["pages"]], img_paths, errors,
+                                           characters=characters, ratio=ratio, use_cache=use_cache, allow_batch=False)
+    return {"story_data": story_data, "img_paths": list(img_paths), "errors": _error_texts(errors)}
+
+
+HANDLERS = {
+    "character": run_character,
+    "images": run_images,
+}
+
+
+def _run_job(record, api_key):
+    # Runs in a copy of the worker's context, so the key stays with this job's thread.
+    set_current_api_key(api_key)
+    try:
+        handler = HANDLERS.get(record["kind"])
+        if handler is None:
+            raise ValueError(f"Unknown job kind {record['kind']!r}")
+        with tracing.span("worker.job", kind=record["kind"], job=record["id"], attempt=record["attempts"]):
+            result = handler(record["id"], record["params"])
+    except Exception as e:
+        print(f"Job {record['id']} failed: {e}")
+        job_queue.fail(record["id"], e)
+        return
+    if result is WAITING:
+        print(f"Job {record['id']} is waiting for its batch job")
+        return
+    job_queue.finish(record["id"], result)
+    print(f"Job {record['id']} finished")
+
+
+def poll_owned_batches(worker_id):
+    """
+    Makes sure the batch jobs of the parked jobs this worker owns are polled, taking over
+    those of stopped workers. Jobs other processes poll are left to them.
+    """
+    from utils.image_utils import resume_image_jobs
+    batch_names = {}
+    for _, batch_job, api_key in job_queue.own_waiting_jobs(worker_id):
+        if api_key and batch_job:
+            batch_names.setdefault(api_key, []).append(batch_job)
+    for api_key, names in batch_names.items():
+        context = contextvars.copy_context()
+        context.run(set_current_api_key, api_key)
+        # Jobs already polled by this process are skipped.
+        context.run(resume_image_jobs, names)
+
+
+def wake_finished_batches():
+    """Queues parked jobs again whose batch job is done, or unknown so that they fail instead of waiting forever."""
+    from utils import batch_jobs
+    woken = []
+    for job_id, batch_job, _ in job_queue.waiting_jobs():
+        record = batch_jobs.get_job(batch_job)
+        if record is None or batch_jobs.is_finished(record):
+            job_queue.wake(job_id)
+            woken.append(job_id)
+    return woken
+
+
+def run_worker(concurrency=WORKER_CONCURRENCY, per_key=job_queue.PER_KEY_CONCURRENCY, poll_seconds=POLL_SECONDS, stop=None):
+    """
+    Claims and runs queued jobs until stop is set, then stops claiming and waits for the
+    running jobs, still heartbeating so no other worker takes them over.
+    """
+    stop = stop or threading.Event()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job")
+    running = {}
+    last_heartbeat = 0.0
+    print(f"Worker {worker_id} started ({concurrency} slots, {per_key} per API key)", flush=True)
+    try:
+        while not stop.is_set() or running:
+            running = {job_id: future for job_id, future in running.items() if not future.done()}
+            if time.time() - last_heartbeat >= job_queue.HEARTBEAT_SECONDS:
+                job_queue.heartbeat(worker_id, list(running), concurrency)
+                requeued = job_queue.requeue_stale()
+                if requeued:
+                    print(f"Requeued jobs of unresponsive workers: {', '.join(requeued)}")
+                poll_owned_batches(worker_id)
+                woken = wake_finished_batches()
+                if woken:
+                    print(f"Batch jobs done, collecting: {', '.join(woken)}")
+                last_heartbeat = time.time()
+            claimed = job_queue.claim(worker_id, per_key) if not stop.is_set() and len(running) < concurrency else None
+            if claimed:
+                record, api_key = claimed
+                print(f"Running {record['kind']} job {record['id']}")
+                running[record["id"]] = pool.submit(contextvars.copy_context().run, _run_job, record, api_key)
+                continue
+            if stop.is_set():
+                # Draining: only heartbeats are left to do.
+                time.sleep(poll_seconds)
+            else:
+                stop.wait(poll_seconds)
+    finally:
+        pool.shutdown(wait=True)
+        job_queue.remove_worker(worker_id)
+        tracing.flush_metrics()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="jobs this worker runs at once")
+    parser.add_argument("--per-key", type=int, default=job_queue.PER_KEY_CONCURRENCY, help="jobs of one API key running at once across all workers")
+    parser.add_argument("--poll-seconds", type=float, default=POLL_SECONDS)
+    args = parser.parse_args()
+
+    # The app owns .cache/traces/metrics.prom; each worker exports its own file next to it.
+    tracing.use_process_metrics_file("worker")
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    run_worker(args.concurrency, args.per_key, args.poll_seconds, stop)
+
+
+if __name__ == "__main__":
+    main()